@@ -917,7 +917,7 @@ async def http_stream_generator(http_url: str, range_header: Optional[str]) -> A
 
 @app.get("/stream/{token}")
 async def stream(token: str, request: Request, range: Optional[str] = Header(None)):
-    ref = await store.get(token, settings.token_ttl_seconds)
+    ref = await store.get(token)
     if not ref:
         raise HTTPException(status_code=404, detail="Invalid or expired token")
     if ref.access == "normal" and not settings.public_stream:
@@ -991,7 +991,7 @@ async def stream(token: str, request: Request, range: Optional[str] = Header(Non
 async def download(token: str, request: Request, range: Optional[str] = Header(None)):
     await ensure_client_started()
 
-    ref = await store.get(token, settings.token_ttl_seconds)
+    ref = await store.get(token)
     if not ref:
         raise HTTPException(status_code=404, detail="Invalid or expired token")
     if not settings.direct_download:
@@ -1068,7 +1068,7 @@ async def render_section(section_id: str, access_filter: str, request: Request)
         tokens = await store.list_section(section_id, settings.history_limit)
         present = 0
         for token in tokens:
-            ref = await store.get(token, settings.token_ttl_seconds)
+            ref = await store.get(token)
             if not ref:
                 continue
             present += 1
@@ -1104,7 +1104,7 @@ async def render_section(section_id: str, access_filter: str, request: Request)
     page = max(page, 1)
     per_page = max(6, min(per_page, 60))
 
-    refs_by_token = await store.get_many(tokens, settings.token_ttl_seconds)
+    refs_by_token = await store.get_many(tokens)
     views_by_token = await store.get_views_many(list(refs_by_token))
 
     grouped: dict[str, dict] = {}
@@ -1292,7 +1292,7 @@ async def debug_section(section_id: str, access: str = "premium"):
     tokens = await store.list_section(section_id, settings.history_limit)
     entries = []
     for token in tokens:
-        ref = await store.get(token, settings.token_ttl_seconds)
+        ref = await store.get(token)
         if not ref:
             entries.append({"token": token, "status": "missing"})
             continue
@@ -1355,7 +1355,7 @@ async def section_auth(section_id: str, request: Request, password: str = Form(.
 
 @app.get("/player/{token}")
 async def player(token: str, request: Request):
-    ref = await store.get(token, settings.token_ttl_seconds)
+    ref = await store.get(token)
     if not ref:
         raise HTTPException(status_code=404, detail="Invalid or expired token")
     if ref.access == "normal" and not settings.public_stream:
@@ -1418,7 +1418,7 @@ async def player(token: str, request: Request):
 
 @app.get("/player/{token}/download")
 async def player_download(token: str, request: Request):
-    ref = await store.get(token, settings.token_ttl_seconds)
+    ref = await store.get(token)
     if not ref:
         raise HTTPException(status_code=404, detail="Invalid or expired token")
     if settings.bot_username:
@@ -1428,7 +1428,7 @@ async def player_download(token: str, request: Request):
 
 @app.post("/player/{token}/like")
 async def player_like(token: str, request: Request):
-    ref = await store.get(token, settings.token_ttl_seconds)
+    ref = await store.get(token)
     if not ref:
         raise HTTPException(status_code=404, detail="Invalid or expired token")
     try:
@@ -1448,7 +1448,7 @@ async def player_like(token: str, request: Request):
 
 @app.post("/player/{token}")
 async def player_password(token: str, request: Request, password: str = Form(...)):
-    ref = await store.get(token, settings.token_ttl_seconds)
+    ref = await store.get(token)
     if not ref:
         raise HTTPException(status_code=404, detail="Invalid or expired token")
     if not password_enabled():
@@ -28,13 +28,14 @@ from aiogram.types import (
     Message,
     URLInputFile,
 )
-from openpyxl import Workbook
+import xlsxwriter
 
+from app.cache import InflightDedupe
 from app.config import get_settings
 from app.db import PremiumDB
 from app.mongo_db import MongoPremiumDB
 from app.mongo_store import MongoTokenStore
-from app.store import FileRef, TokenStore
+from app.store import FileRef, TokenStore, token_pool
 
 settings = get_settings()
 store = (
@@ -73,6 +74,8 @@ CREDIT_COST = 1
 DEFAULT_CREDIT_PRICE_INR = 0.45
 DEFAULT_PAY_TEXT = "Price per credit: INR {price}\nTo add credits, contact admin."
 ADMIN_CONTACT = "@azmoviedeal"
+PLAYER_PREFIX = f"{settings.base_url}/player/"
+SECTION_PREFIX = f"{settings.base_url}/section/"
 PREMIUM_MONTHLY_PRICE_INR = 499.0
 PREMIUM_MONTHLY_DAYS = 30
 MIN_CUSTOM_PAY_INR = 10.0
@@ -308,8 +311,13 @@ ADMIN_COMMANDS = PUBLIC_COMMANDS + [
 def is_admin(user_id: int | None) -> bool:
     return bool(user_id and user_id in settings.admin_ids)
 
+
+def _two_tokens() -> tuple[str, str]:
+    return token_pool.take(), token_pool.take()
+
+
 def build_link(token: str) -> str:
-    return f"{settings.base_url}/player/{token}"
+    return PLAYER_PREFIX + token
 
 
 def _is_http_url(url: str) -> bool:
@@ -318,7 +326,7 @@ def _is_http_url(url: str) -> bool:
 
 
 def _section_link_value(section_id: str) -> str:
-    section_url = f"{settings.base_url}/section/{section_id}"
+    section_url = SECTION_PREFIX + section_id
     if _is_http_url(section_url):
         return link("Open Section", section_url)
     return code(section_url or "BASE_URL not configured")
@@ -1381,7 +1389,7 @@ async def _resume_captcha_request(message: Message, pending_request: dict, user_
 
 
 async def _deliver_token(message: Message, token: str, *, user_id_override: int | None = None) -> bool:
-    ref = await store.get(token, settings.token_ttl_seconds)
+    ref = await store.get(token)
     if not ref:
         await message.reply(format_msg("❌ Not Found", sections=[("", "This link is invalid or has expired.")]), parse_mode="HTML")
         return False
@@ -1471,7 +1479,7 @@ async def _send_section_tokens(
 
     selected_tokens: list[str] = []
     for token in tokens:
-        ref = await store.get(token, settings.token_ttl_seconds)
+        ref = await store.get(token)
         if not ref:
             continue
         if (ref.access or "normal").strip().lower() == access_filter:
@@ -2496,9 +2504,11 @@ async def admin_approve_callback(callback: CallbackQuery) -> None:
                 )
             await callback.answer("Already handled by another admin.", show_alert=True)
             return
-        balance = await store.add_credits(user_id, credits)
+        balance = await store.finalize_payment(
+            req_id, user_id, credits, "processed", note=f"{credits} credits added. New balance:", admin_id=admin_id,
+            append_balance=True, clear_utr=False,
+        )
         admin_note = f"{credits} credits added. New balance: {balance}"
-        await store.set_payment_request_status(req_id, "processed", note=admin_note, admin_id=admin_id)
         try:
             await bot.send_message(
                 user_id,
@@ -2716,9 +2726,11 @@ async def approve_cmd(message: Message) -> None:
                 )
             await message.reply(format_msg("ℹ️ Already Handled", sections=[("Request", code(req_id))]), parse_mode="HTML")
             return
-        balance = await store.add_credits(user_id, credits)
+        balance = await store.finalize_payment(
+            req_id, user_id, credits, "processed", note=f"{credits} credits • balance:", admin_id=admin_id,
+            append_balance=True, clear_utr=False,
+        )
         result = f"{credits} credits • balance: {balance}"
-        await store.set_payment_request_status(req_id, "processed", note=result, admin_id=admin_id)
         try:
             await bot.send_message(
                 user_id,
@@ -2833,21 +2845,25 @@ async def payments_cmd(message: Message) -> None:
     await message.reply(format_msg(f"📄 Payments ({esc(status)})", sections=[("", "\n".join(lines))]), parse_mode="HTML")
 
 
+def _build_payments_xlsx(rows: list[dict]) -> bytes:
+    data = io.BytesIO()
+    wb = xlsxwriter.Workbook(data, {"in_memory": True})
+    ws = wb.add_worksheet("payments")
+    ws.write_row(0, 0, ["id", "user_id", "amount_inr", "credits", "plan_type", "gateway", "status", "note", "created_at", "updated_at", "expires_at", "admin_id", "approved_by", "grant_type", "txn_id"])
+    for row_idx, r in enumerate(rows, 1):
+        ws.write_row(row_idx, 0, [r.get("id"), r.get("user_id"), r.get("amount_inr"), r.get("credits"), r.get("plan_type"), r.get("gateway"), r.get("status"), r.get("note"), r.get("created_at"), r.get("updated_at"), r.get("expires_at"), r.get("admin_id"), r.get("approved_by"), r.get("grant_type"), r.get("txn_id")])
+    wb.close()
+    return data.getvalue()
+
+
 @dp.message(Command("paydb"))
 async def paydb_cmd(message: Message) -> None:
     if not is_admin(message.from_user.id if message.from_user else None):
         await message.reply(format_msg("❌ Access Denied", sections=[("", "Admins only.")]), parse_mode="HTML")
         return
     rows = await store.list_payment_requests(status="all", limit=1000)
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "payments"
-    ws.append(["id", "user_id", "amount_inr", "credits", "plan_type", "gateway", "status", "note", "created_at", "updated_at", "expires_at", "admin_id", "approved_by", "grant_type", "txn_id"])
-    for r in rows:
-        ws.append([r.get("id"), r.get("user_id"), r.get("amount_inr"), r.get("credits"), r.get("plan_type"), r.get("gateway"), r.get("status"), r.get("note"), r.get("created_at"), r.get("updated_at"), r.get("expires_at"), r.get("admin_id"), r.get("approved_by"), r.get("grant_type"), r.get("txn_id")])
-    data = io.BytesIO()
-    wb.save(data)
-    await bot.send_document(message.chat.id, document=BufferedInputFile(data.getvalue(), filename="payments.xlsx"))
+    data = await asyncio.to_thread(_build_payments_xlsx, rows)
+    await bot.send_document(message.chat.id, document=BufferedInputFile(data, filename="payments.xlsx"))
 
 
 @dp.message(Command("resetpaydb"))
@@ -2942,11 +2958,13 @@ async def showsections_cmd(message: Message) -> None:
         return
     rows.sort(key=lambda x: x[0].lower())
     lines = []
+    # Scheme and host come from the prefix alone, so check it once rather than per section.
+    http_links = _is_http_url(SECTION_PREFIX)
     for name, sid in rows:
         views_total, views_unique = await store.get_section_views(sid)
         label = (
-            f"• {link(name, f'{settings.base_url}/section/{sid}')}"
-            if _is_http_url(f"{settings.base_url}/section/{sid}")
+            f"• {link(name, SECTION_PREFIX + sid)}"
+            if http_links
             else f"• {esc(name)} ({code(sid)})"
         )
         lines.append(f"{label} — visits: {code(views_total)} | unique: {code(views_unique)}")
@@ -3256,8 +3274,7 @@ async def stream_filename_entered(message: Message, state: FSMContext) -> None:
         custom_name = data.get("default_name", "file.mp4")
 
     # Set up tokens
-    normal_token = secrets.token_urlsafe(24)
-    premium_token = secrets.token_urlsafe(24)
+    normal_token, premium_token = _two_tokens()
 
     # Default to current section if none exists, or use "stream" section fallback
     section_id, section_name = await store.get_section()
@@ -3278,7 +3295,7 @@ async def stream_filename_entered(message: Message, state: FSMContext) -> None:
         except Exception as e:
             logger.warning(f"Failed to copy media to STREAM_DUMP_CHAT_ID ({stream_dump}): {e}")
 
-    base_ref = dict(
+    normal_ref = FileRef(
         file_id=data["file_id"],
         chat_id=target_chat_id,
         message_id=target_message_id,
@@ -3287,17 +3304,21 @@ async def stream_filename_entered(message: Message, state: FSMContext) -> None:
         mime_type=data["mime_type"],
         file_size=data["file_size"],
         media_type=data["media_type"],
+        access="normal",
         created_at=time.time(),
         section_id=section_id,
         section_name=section_name,
+        dl_token=premium_token,
     )
 
     # Store token references
-    await store.set(normal_token, FileRef(**base_ref, access="normal", dl_token=premium_token), settings.token_ttl_seconds)
-    await store.set(premium_token, FileRef(**base_ref, access="premium"), settings.token_ttl_seconds)
+    await store.set_many([
+        (normal_token, normal_ref, settings.token_ttl_seconds),
+        (premium_token, normal_ref.with_access("premium", dl_token=None), settings.token_ttl_seconds),
+    ])
 
     normal_link = build_link(normal_token)
-    premium_link = f"{settings.base_url}/player/{premium_token}/download"
+    premium_link = f"{PLAYER_PREFIX}{premium_token}/download"
 
     await message.reply(
         format_msg(
@@ -3326,9 +3347,9 @@ async def publicsections_cmd(message: Message) -> None:
         return
     rows.sort(key=lambda x: x[0].lower())
     lines = []
+    http_links = _is_http_url(SECTION_PREFIX)
     for name, sid in rows:
-        section_url = f"{settings.base_url}/section/{sid}"
-        label = link(name, section_url) if _is_http_url(section_url) else f"{esc(name)} ({code(sid)})"
+        label = link(name, SECTION_PREFIX + sid) if http_links else f"{esc(name)} ({code(sid)})"
         lines.append(f"• {label}")
     public_url = f"{settings.base_url}/sections"
     await message.reply(
@@ -3818,15 +3839,11 @@ async def history_cmd(message: Message) -> None:
             limit = max(1, min(int(parts[1]), 100))
         except Exception:
             pass
-    tokens = await store.list_recent(limit * 2)
-    lines = []
-    for token in tokens:
-        ref = await store.get(token, settings.token_ttl_seconds)
-        if not ref:
-            continue
-        lines.append(f"• [{esc(ref.access)}] {esc(ref.section_name or '-')}: {link('🔗 Open', build_link(token))}")
-        if len(lines) >= limit:
-            break
+    recent = await store.list_recent_refs(limit, scan=limit * 2)
+    lines = [
+        f"• [{esc(ref.access)}] {esc(ref.section_name or '-')}: {link('🔗 Open', build_link(token))}"
+        for token, ref in recent
+    ]
     if not lines:
         await message.reply(format_msg("📜 History", sections=[("", "No history yet.")]), parse_mode="HTML")
         return
@@ -4119,10 +4136,7 @@ async def _startup() -> None:
     global _payment_expiry_task
     await store.connect()
     await db.connect()
-    for admin_id in settings.admin_ids:
-        await db.add_admin(admin_id)
-    admins = await db.list_admins()
-    settings.admin_ids.update(admins)
+    settings.admin_ids.update(await db.seed_admins(tuple(settings.admin_ids)))
     try:
         from aiogram.types import BotCommandScopeDefault, BotCommandScopeChat
         await bot.set_my_commands(PUBLIC_COMMANDS, scope=BotCommandScopeDefault())
@@ -4458,6 +4472,12 @@ async def utr_text_fallback_handler(message: Message, state: FSMContext) -> None
 #  Media upload handler (Catch-all MUST be at the bottom)
 # ---------------------------------------------------------------------------
 
+UPLOAD_DEDUPE_SECONDS = 5
+
+# (file_unique_id, section_id) -> (normal_token, premium_token), so a repost or redelivered update
+# inside the window reuses its tokens instead of writing new ones.
+_recent_uploads = InflightDedupe(maxsize=1024, ttl=UPLOAD_DEDUPE_SECONDS)
+
 @dp.message()
 async def private_media_handler(message: Message, state: FSMContext) -> None:
     if message.chat.type not in {"private", "channel"}:
@@ -4487,28 +4507,39 @@ async def private_media_handler(message: Message, state: FSMContext) -> None:
             await message.reply(format_msg("⚠️ No Active Section", sections=[("", f"Set one first: {code('/addsection <name>')}")]), parse_mode="HTML")
         return
 
-    normal_token = secrets.token_urlsafe(24)
-    premium_token = secrets.token_urlsafe(24)
-    file_name = getattr(media, "file_name", None)
-    mime_type = getattr(media, "mime_type", None)
-    file_size = getattr(media, "file_size", None)
+    dedupe_key = (media.file_unique_id, section_id)
+    claim = await _recent_uploads.claim(dedupe_key, (message.chat.id, message.message_id), _two_tokens())
+    if claim is None:
+        return
+    fresh, (normal_token, premium_token) = claim
+    if fresh:
+        file_name = getattr(media, "file_name", None)
+        mime_type = getattr(media, "mime_type", None)
+        file_size = getattr(media, "file_size", None)
 
-    media_type = "document"
-    if message.video: media_type = "video"
-    elif message.audio: media_type = "audio"
-    elif message.animation: media_type = "animation"
-    elif message.voice: media_type = "voice"
-    elif message.video_note: media_type = "video_note"
-    elif message.photo: media_type = "photo"
-
-    base_ref = dict(
-        file_id=media.file_id, chat_id=message.chat.id, message_id=message.message_id,
-        file_unique_id=media.file_unique_id, file_name=file_name, mime_type=mime_type,
-        file_size=file_size, media_type=media_type, created_at=time.time(),
-        section_id=section_id, section_name=section_name,
-    )
-    await store.set(normal_token, FileRef(**base_ref, access="normal"), settings.token_ttl_seconds)
-    await store.set(premium_token, FileRef(**base_ref, access="premium"), settings.token_ttl_seconds)
+        media_type = "document"
+        if message.video: media_type = "video"
+        elif message.audio: media_type = "audio"
+        elif message.animation: media_type = "animation"
+        elif message.voice: media_type = "voice"
+        elif message.video_note: media_type = "video_note"
+        elif message.photo: media_type = "photo"
+
+        normal_ref = FileRef(
+            file_id=media.file_id, chat_id=message.chat.id, message_id=message.message_id,
+            file_unique_id=media.file_unique_id, file_name=file_name, mime_type=mime_type,
+            file_size=file_size, media_type=media_type, access="normal", created_at=time.time(),
+            section_id=section_id, section_name=section_name,
+        )
+        try:
+            await store.set_many([
+                (normal_token, normal_ref, settings.token_ttl_seconds),
+                (premium_token, normal_ref.with_access("premium"), settings.token_ttl_seconds),
+            ])
+        except BaseException:
+            _recent_uploads.resolve(dedupe_key, False)
+            raise
+        _recent_uploads.resolve(dedupe_key, True)
 
     if message.chat.type == "private":
         await message.reply(
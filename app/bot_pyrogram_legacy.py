@@ -1,25 +1,35 @@
 ﻿import asyncio
+from collections import defaultdict, deque
+from functools import partial
+import heapq
 from html import escape
 import logging
+import logging.handlers
+import operator
+import os
+import queue
 import re
-import secrets
 import time
 import tempfile
 from pathlib import Path
 from urllib.parse import quote
 
-from openpyxl import Workbook
-from pyrogram import Client, filters, enums
+import xlsxwriter
+from pyrogram import Client, filters, enums, idle
 from pyrogram.types import BotCommand, InlineKeyboardButton, InlineKeyboardMarkup
 from pyrogram.errors import FloodWait
 
+from app.cache import InflightDedupe, TTLCache
 from app.config import get_settings
 from app.db import PremiumDB
 from app.mongo_db import MongoPremiumDB
 from app.mongo_store import MongoTokenStore
-from app.store import FileRef, TokenStore
+from app.ratelimit import RateLimiter
+from app.store import FileRef, TokenStore, token_pool
 
 settings = get_settings()
+# Same set object as settings.admin_ids: /addadmin and startup mutate it in place.
+_ADMIN_IDS = settings.admin_ids
 store = (
     MongoTokenStore(settings.redis_url, settings.mongo_uri, settings.mongo_db_name, history_limit=settings.history_limit)
     if settings.mongo_uri
@@ -34,6 +44,9 @@ db = (
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 logger = logging.getLogger("stream_bot")
 
+# Telegram's documented send limits: ~30 msg/s per bot, ~1 msg/s per chat.
+limiter = RateLimiter(global_rate=25, global_burst=30, chat_rate=1, chat_burst=1, flood_error=FloodWait)
+
 app = Client(
     "stream_bot",
     api_id=settings.api_id,
@@ -42,15 +55,25 @@ app = Client(
     sleep_threshold=10000,
 )
 
-VIDEO_EXTS = {".mp4", ".mkv", ".mov", ".webm", ".avi", ".mpeg", ".mpg", ".m4v"}
+VIDEO_EXTS = frozenset({".mp4", ".mkv", ".mov", ".webm", ".avi", ".mpeg", ".mpg", ".m4v"})
 CREDIT_COST = 1
 DEFAULT_CREDIT_PRICE_INR = 0.35
 DEFAULT_PAY_TEXT = "Price per credit: INR {price}\nTo add credits, contact admin."
 ADMIN_CONTACT = "@azmoviedeal"
+ADMIN_CONTACT_URL = f"https://telegram.me/{ADMIN_CONTACT.lstrip('@')}"
+PLAYER_PREFIX = f"{settings.base_url}/player/"
+SECTION_PREFIX = f"{settings.base_url}/section/"
 MIN_CUSTOM_PAY_INR = 10.0
 DEFAULT_UPI_PAYEE_NAME = "AZ File Conversion"
 PREMIUM_MONTHLY_PRICE_INR = 499.0
 PREMIUM_MONTHLY_DAYS = 30
+PAY_CONFIG_CACHE_SECONDS = 30
+SECTION_CACHE_SECONDS = 10
+_LIFETIME = frozenset({"life", "lifetime", "permanent", "perm"})
+# sa_<section_id>_<access>; the greedy group splits on the last underscore.
+_SA_RE = re.compile(r"sa_(.*)_\s*((?i:normal|premium))\s*", re.DOTALL)
+# Literal backslash escapes typed by admins; \r\n is listed first so it collapses to one newline.
+_ESCAPED_NEWLINE_RE = re.compile(r"\\r\\n|\\n|\\r")
 KNOWN_COMMANDS = [
     "start", "pay", "paid", "add", "addsection", "addsections", "endsection",
     "delsection", "showsections", "showsection", "sections", "setcreditprice",
@@ -65,13 +88,20 @@ def bullet_lines(items: list[str]) -> str:
 
 
 def build_link(token: str) -> str:
-    return f"{settings.base_url}/player/{token}"
+    return PLAYER_PREFIX + token
 
 
 def is_admin(user_id: int | None) -> bool:
-    if not user_id:
-        return False
-    return user_id in settings.admin_ids
+    return user_id in _ADMIN_IDS if user_id else False
+
+
+def _two_tokens() -> tuple[str, str]:
+    return token_pool.take(), token_pool.take()
+
+
+def _uid(message) -> int | None:
+    user = message.from_user
+    return user.id if user else None
 
 
 def build_bot_commands() -> list[BotCommand]:
@@ -96,32 +126,57 @@ def build_bot_commands() -> list[BotCommand]:
 
 def parse_period(value: str) -> int | None:
     value = value.strip().lower()
-    if value in {"life", "lifetime", "permanent", "perm"}:
+    if value in _LIFETIME:
         return None
     return int(value)
 
 def is_video_document(message) -> bool:
-    if not message.document:
+    doc = message.document
+    if not doc:
         return False
-    mime = (message.document.mime_type or "").lower()
-    name = message.document.file_name or ""
-    ext = Path(name).suffix.lower()
-    return mime.startswith("video/") or ext in VIDEO_EXTS
+    mime = doc.mime_type
+    # Only the six-char prefix needs case folding, not the whole mime string.
+    if mime and mime[:6].lower() == "video/":
+        return True
+    name = doc.file_name or ""
+    dot = name.rfind(".")
+    return dot > 0 and name[dot:].lower() in VIDEO_EXTS
+
+
+REUPLOAD_IN_MEMORY_MAX_BYTES = 50 * 1024 * 1024
+# Caps concurrent download+send cycles so a burst of large videos doesn't split disk and bandwidth N ways.
+_REUPLOAD_SEM = asyncio.Semaphore(settings.reupload_concurrency)
+
 
 async def reupload_video_as_media(client: Client, message, target_chat_id):
     if not message.document:
         return None
-    caption = message.caption
-    with tempfile.TemporaryDirectory() as tmpdir:
-        target_path = Path(tmpdir) / (message.document.file_name or "video.mp4")
-        download_path = await message.download(file_name=str(target_path))
-        if not download_path:
-            return None
-        return await client.send_video(
-            chat_id=target_chat_id,
-            video=download_path,
-            caption=caption,
-        )
+    async with _REUPLOAD_SEM:
+        caption = message.caption
+        if (message.document.file_size or 0) <= REUPLOAD_IN_MEMORY_MAX_BYTES:
+            # Small enough to keep in RAM: download to a BytesIO and upload straight from it.
+            buffer = await message.download(in_memory=True)
+            if not buffer:
+                return None
+            buffer.seek(0)
+            return await client.send_video(chat_id=target_chat_id, video=buffer, caption=caption)
+        ext = Path(message.document.file_name or "video.mp4").suffix or ".mp4"
+        fd, target_path = tempfile.mkstemp(suffix=ext, dir=settings.tmp_dir)
+        os.close(fd)
+        try:
+            download_path = await message.download(file_name=target_path)
+            if not download_path:
+                return None
+            return await client.send_video(
+                chat_id=target_chat_id,
+                video=download_path,
+                caption=caption,
+            )
+        finally:
+            try:
+                os.unlink(target_path)
+            except OSError:
+                pass
 
 def build_reaction_keyboard(token: str, likes: int, dislikes: int, status: int) -> InlineKeyboardMarkup:
     like_label = f"👍 {likes}" + (" ✅" if status == 1 else "")
@@ -134,63 +189,133 @@ def build_reaction_keyboard(token: str, likes: int, dislikes: int, status: int)
     )
 
 
+REACTION_EDIT_DELAY = 0.5
+
+_background_tasks: set[asyncio.Task] = set()
+
+# (chat_id, message_id) -> latest (message, keyboard); flushed once per delay window.
+_pending_reaction_edits: dict[tuple[int, int], tuple[object, InlineKeyboardMarkup]] = {}
+
+
+def queue_reaction_edit(message, markup: InlineKeyboardMarkup) -> None:
+    key = (message.chat.id, message.id)
+    first = key not in _pending_reaction_edits
+    _pending_reaction_edits[key] = (message, markup)
+    if first:
+        task = asyncio.create_task(_flush_reaction_edit(key))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+
+async def _flush_reaction_edit(key: tuple[int, int]) -> None:
+    await asyncio.sleep(REACTION_EDIT_DELAY)
+    message, markup = _pending_reaction_edits.pop(key)
+    try:
+        await limiter.send(lambda: message.edit_reply_markup(reply_markup=markup), key[0])
+    except Exception:
+        pass
+
+
 async def send_reaction_prompt(client: Client, user_id: int, token: str) -> None:
     likes, dislikes, status = await store.get_reactions(token, user_id)
-    await client.send_message(
-        chat_id=user_id,
-        text="Rate this file:",
-        reply_markup=build_reaction_keyboard(token, likes, dislikes, status),
+    markup = build_reaction_keyboard(token, likes, dislikes, status)
+    await limiter.send(
+        lambda: client.send_message(chat_id=user_id, text="Rate this file:", reply_markup=markup),
+        user_id,
     )
 
 
 DELETE_AFTER_SECONDS = 30 * 60
 PAYMENT_QR_DELETE_SECONDS = 15 * 60
+DELETE_BATCH_SIZE = 100  # Telegram caps deleteMessages at 100 ids
+
+
+class DeleteScheduler:
+    """
+    One background coroutine draining a (deadline, chat_id, message_id) heap.
+    schedule() only wakes the worker when the new entry becomes the earliest deadline.
+    """
+
+    def __init__(self) -> None:
+        self._heap: list[tuple[float, int, int]] = []
+        self._wake = asyncio.Event()
+
+    def schedule(self, chat_id: int, message_id: int, delay: int = DELETE_AFTER_SECONDS) -> None:
+        deadline = time.monotonic() + delay
+        heapq.heappush(self._heap, (deadline, chat_id, message_id))
+        if self._heap[0][0] == deadline:
+            self._wake.set()
+
+    async def run(self, client: Client) -> None:
+        heap = self._heap
+        while True:
+            now = time.monotonic()
+            pending: dict[int, list[int]] = defaultdict(list)
+            while heap and heap[0][0] <= now:
+                _, chat_id, message_id = heapq.heappop(heap)
+                pending[chat_id].append(message_id)
+            if pending:
+                await asyncio.gather(
+                    *(
+                        limiter.send(
+                            partial(client.delete_messages, chat_id=chat_id, message_ids=message_ids[i:i + DELETE_BATCH_SIZE]),
+                            chat_id,
+                        )
+                        for chat_id, message_ids in pending.items()
+                        for i in range(0, len(message_ids), DELETE_BATCH_SIZE)
+                    ),
+                    return_exceptions=True,
+                )
+            # Cleared before reading the heap, so a schedule() during the gather above is not missed.
+            self._wake.clear()
+            timeout = heap[0][0] - time.monotonic() if heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
 
-async def schedule_delete(client: Client, chat_id: int, message_id: int, delay: int = DELETE_AFTER_SECONDS) -> None:
-    await asyncio.sleep(delay)
-    try:
-        await client.delete_messages(chat_id=chat_id, message_ids=message_id)
-    except Exception:
-        pass
+delete_scheduler = DeleteScheduler()
 
 
 async def send_premium_file(client: Client, user_id: int, ref: FileRef, protect: bool) -> None:
     try:
-        sent = await client.copy_message(
-            chat_id=user_id,
-            from_chat_id=ref.chat_id,
-            message_id=ref.message_id,
-            protect_content=protect,
+        sent = await limiter.send(
+            lambda: client.copy_message(
+                chat_id=user_id,
+                from_chat_id=ref.chat_id,
+                message_id=ref.message_id,
+                protect_content=protect,
+            ),
+            user_id,
         )
         if sent:
-            asyncio.create_task(schedule_delete(client, user_id, sent.id))
+            delete_scheduler.schedule(user_id, sent.id)
         return
     except Exception:
         pass
-    sent = await client.send_cached_media(
-        chat_id=user_id,
-        file_id=ref.file_id,
-        protect_content=protect,
+    sent = await limiter.send(
+        lambda: client.send_cached_media(
+            chat_id=user_id,
+            file_id=ref.file_id,
+            protect_content=protect,
+        ),
+        user_id,
     )
     if sent:
-        asyncio.create_task(schedule_delete(client, user_id, sent.id))
+        delete_scheduler.schedule(user_id, sent.id)
 
 
 def parse_send_all_payload(payload: str) -> tuple[str, str] | None:
     if not payload.startswith("sa_"):
         return None
-    rest = payload[3:]
-    section_id, sep, access = rest.rpartition("_")
-    if not sep:
-        return None
-    access = access.strip().lower()
-    if access not in {"normal", "premium"}:
+    match = _SA_RE.fullmatch(payload)
+    if not match:
         return None
-    section_id = section_id.strip()
+    section_id = match.group(1).strip()
     if not section_id:
         return None
-    return section_id, access
+    return section_id, match.group(2).lower()
 
 
 def render_pay_text(template: str, price: float) -> str:
@@ -203,12 +328,7 @@ def render_pay_text(template: str, price: float) -> str:
 
 def normalize_plan_text(raw_text: str) -> str:
     # Allow admins to type escaped newlines in Telegram commands.
-    return (
-        raw_text.replace("\\r\\n", "\n")
-        .replace("\\n", "\n")
-        .replace("\\r", "\n")
-        .strip()
-    )
+    return _ESCAPED_NEWLINE_RE.sub("\n", raw_text).strip()
 
 
 def parse_amount_value(raw: str) -> float | None:
@@ -265,7 +385,7 @@ def build_payment_request_keyboard(request_id: str) -> InlineKeyboardMarkup:
                 InlineKeyboardButton("Send UTR", callback_data=f"payreq:utr:{request_id}"),
                 InlineKeyboardButton("Cancel", callback_data=f"payreq:cancel:{request_id}"),
             ],
-            [InlineKeyboardButton("Contact Admin", url=f"https://telegram.me/{ADMIN_CONTACT.lstrip('@')}")],
+            [InlineKeyboardButton("Contact Admin", url=ADMIN_CONTACT_URL)],
         ]
     )
 
@@ -323,7 +443,7 @@ async def send_payment_request_message(client: Client, chat_id: int, req: dict,
         )
     if sent:
         await store.set_payment_prompt(request_id, chat_id, sent.id)
-        asyncio.create_task(schedule_delete(client, chat_id, sent.id, PAYMENT_QR_DELETE_SECONDS))
+        delete_scheduler.schedule(chat_id, sent.id, PAYMENT_QR_DELETE_SECONDS)
 
 
 
@@ -435,8 +555,7 @@ async def approve_payment_request(client: Client, request_id: str, admin_id: int
     plan_type = str(req.get("plan_type", "credits") or "credits")
     if plan_type == "premium_30d":
         await db.add_user(user_id, PREMIUM_MONTHLY_DAYS)
-        await store.set_payment_request_status(request_id, "approved", note=note, admin_id=admin_id)
-        await store.clear_pending_utr(user_id)
+        await store.finalize_payment(request_id, user_id, 0, "approved", note=note, admin_id=admin_id)
         await delete_payment_prompt_message(client, request_id)
         try:
             await client.send_message(user_id, f"Your payment {request_id} is approved. Premium activated for {PREMIUM_MONTHLY_DAYS} days.")
@@ -448,9 +567,7 @@ async def approve_payment_request(client: Client, request_id: str, admin_id: int
     credits = int(req.get("credits", 0) or 0)
     if credits <= 0:
         return False, "Invalid request data."
-    balance = await store.add_credits(user_id, credits)
-    await store.set_payment_request_status(request_id, "approved", note=note, admin_id=admin_id)
-    await store.clear_pending_utr(user_id)
+    balance = await store.finalize_payment(request_id, user_id, credits, "approved", note=note, admin_id=admin_id)
     await delete_payment_prompt_message(client, request_id)
     try:
         await client.send_message(user_id, f"Your payment {request_id} is approved. Credits added: {credits}. Balance: {balance}")
@@ -483,25 +600,59 @@ async def reject_payment_request(client: Client, request_id: str, admin_id: int,
     return True, f"Rejected {request_id}."
 
 
-def build_pay_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
+# Static, so built once; Pyrogram only reads it when serialising each send.
+PAY_KEYBOARD = InlineKeyboardMarkup(
+    [
         [
-            [
-                InlineKeyboardButton("10rs", callback_data="payamt:10"),
-                InlineKeyboardButton("50rs", callback_data="payamt:50"),
-            ],
-            [
-                InlineKeyboardButton("100rs", callback_data="payamt:100"),
-                InlineKeyboardButton("Custom amount (>10rs)", callback_data="payamt:custom"),
-            ],
-            [InlineKeyboardButton("Premium 499", callback_data="payamt:premium")],
-            [InlineKeyboardButton("Contact Admin", url=f"https://telegram.me/{ADMIN_CONTACT.lstrip('@')}")],
-        ]
-    )
+            InlineKeyboardButton("10rs", callback_data="payamt:10"),
+            InlineKeyboardButton("50rs", callback_data="payamt:50"),
+        ],
+        [
+            InlineKeyboardButton("100rs", callback_data="payamt:100"),
+            InlineKeyboardButton("Custom amount (>10rs)", callback_data="payamt:custom"),
+        ],
+        [InlineKeyboardButton("Premium 499", callback_data="payamt:premium")],
+        [InlineKeyboardButton("Contact Admin", url=ADMIN_CONTACT_URL)],
+    ]
+)
+
+
+# kind -> (fetched_at, value) for the pay plan, UPI id and active section.
+_cfg_cache: dict[str, tuple[float, object]] = {}
+
+
+async def cached_pay_plan() -> tuple[float, str]:
+    now = time.monotonic()
+    entry = _cfg_cache.get("plan")
+    if entry and now - entry[0] < PAY_CONFIG_CACHE_SECONDS:
+        return entry[1]
+    value = await store.get_pay_plan(DEFAULT_CREDIT_PRICE_INR, DEFAULT_PAY_TEXT)
+    _cfg_cache["plan"] = (now, value)
+    return value
+
+
+async def cached_upi_id() -> str:
+    now = time.monotonic()
+    entry = _cfg_cache.get("upi")
+    if entry and now - entry[0] < PAY_CONFIG_CACHE_SECONDS:
+        return entry[1]
+    value = await store.get_upi_id()
+    _cfg_cache["upi"] = (now, value)
+    return value
+
+
+async def cached_section() -> tuple[str | None, str | None]:
+    now = time.monotonic()
+    entry = _cfg_cache.get("section")
+    if entry and now - entry[0] < SECTION_CACHE_SECONDS:
+        return entry[1]
+    value = await store.get_section()
+    _cfg_cache["section"] = (now, value)
+    return value
 
 
 async def create_payment_request_for_amount(user_id: int, amount_inr: float) -> tuple[dict | None, str | None]:
-    price, _ = await store.get_pay_plan(DEFAULT_CREDIT_PRICE_INR, DEFAULT_PAY_TEXT)
+    price, _ = await cached_pay_plan()
     credits = credits_for_amount(amount_inr, price)
     if credits < 1:
         return None, f"Amount is too low. Minimum amount for 1 credit is INR {price:.2f}."
@@ -529,8 +680,15 @@ def format_plan_label(req: dict) -> str:
         return f"Premium {PREMIUM_MONTHLY_DAYS} days (unlimited credits)"
     return f"Credits: {int(req.get('credits', 0) or 0)}"
 
-async def deliver_token(client: Client, user_id: int, token: str, include_guidance: bool = True) -> bool:
-    ref = await store.get(token, settings.token_ttl_seconds)
+async def deliver_token(
+    client: Client,
+    user_id: int,
+    token: str,
+    include_guidance: bool = True,
+    ref: FileRef | None = None,
+) -> bool:
+    if ref is None:
+        ref = await store.get(token)
     if not ref:
         return False
     is_premium = await db.is_premium(user_id)
@@ -541,43 +699,47 @@ async def deliver_token(client: Client, user_id: int, token: str, include_guidan
             return True
         ok, balance = await store.charge_credits(user_id, CREDIT_COST)
         if not ok:
-            await client.send_message(chat_id=user_id, text=f"Not enough credits. Balance: {balance}. 💳")
+            await limiter.send(
+                lambda: client.send_message(chat_id=user_id, text=f"Not enough credits. Balance: {balance}. 💳"),
+                user_id,
+            )
             return False
         try:
             await send_premium_file(client, user_id, ref, protect=False)
         except Exception:
             await store.add_credits(user_id, CREDIT_COST)
             raise
-        await client.send_message(chat_id=user_id, text=f"✅ 1 credit used. Remaining: {balance}")
+        await limiter.send(
+            lambda: client.send_message(chat_id=user_id, text=f"✅ 1 credit used. Remaining: {balance}"),
+            user_id,
+        )
         await send_reaction_prompt(client, user_id, token)
         return True
 
     await send_premium_file(client, user_id, ref, protect=True)
     await send_reaction_prompt(client, user_id, token)
     if include_guidance:
-        await client.send_message(
-            chat_id=user_id,
-            text=(
-                "Play-only mode enabled (saving/forwarding is blocked). 🔒\n"
-                "Want full download access? Use /pay to buy credits or ask for premium."
+        await limiter.send(
+            lambda: client.send_message(
+                chat_id=user_id,
+                text=(
+                    "Play-only mode enabled (saving/forwarding is blocked). 🔒\n"
+                    "Want full download access? Use /pay to buy credits or ask for premium."
+                ),
             ),
+            user_id,
         )
     return True
 
 
-@app.on_message(
-    filters.private & filters.regex(r"^/start(?:@[A-Za-z0-9_]+)?(?:\s|$)"),
-    group=-1,
-)
 async def start_handler(client: Client, message):
-    logger.info(
-        "START HIT uid=%s text=%r",
-        message.from_user.id if message.from_user else None,
-        message.text,
-    )
-    text = message.text or ""
-    parts = text.split(maxsplit=1)
-    if len(parts) < 2:
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "START HIT uid=%s text=%r",
+            message.from_user.id if message.from_user else None,
+            message.text,
+        )
+    if len(message.command) < 2:
         await message.reply_text(
             "\U0001F44B <b><u>Welcome to FileLord</u></b>\n\n"
             "\u2728 <b><u>Overview</u></b>\n"
@@ -610,7 +772,8 @@ async def start_handler(client: Client, message):
         return
 
     user_id = message.from_user.id
-    payload = parts[1].strip()
+    # The raw remainder, not command[1]: sa_ payloads may contain spaces in the section name.
+    payload = (message.text or "").split(maxsplit=1)[1].strip()
     if payload.startswith("dl_"):
         token = payload[3:]
         ok = await deliver_token(client, user_id, token, include_guidance=True)
@@ -624,28 +787,20 @@ async def start_handler(client: Client, message):
         return
 
     section_id, access_filter = send_all
-    tokens = await store.list_section(section_id, settings.history_limit)
-    if not tokens:
-        await message.reply_text("No files found in this section. 📭")
-        return
-
-    selected_tokens: list[str] = []
-    for token in tokens:
-        ref = await store.get(token, settings.token_ttl_seconds)
-        if not ref:
-            continue
-        if (ref.access or "normal").strip().lower() == access_filter:
-            selected_tokens.append(token)
-    if not selected_tokens:
+    selected = await store.list_section_refs(
+        section_id, settings.history_limit, access=access_filter
+    )
+    if not selected:
         await message.reply_text("No matching files found for this section access. 📭")
         return
 
-    await message.reply_text(f"Sending {len(selected_tokens)} files from section `{section_id}` ({access_filter}).")
+    await message.reply_text(f"Sending {len(selected)} files from section `{section_id}` ({access_filter}).")
     sent_count = 0
     skipped_count = 0
-    for token in selected_tokens:
+    # One at a time, so the files arrive in section order.
+    for token, ref in selected:
         try:
-            ok = await deliver_token(client, user_id, token, include_guidance=False)
+            ok = await deliver_token(client, user_id, token, include_guidance=False, ref=ref)
             if ok:
                 sent_count += 1
             else:
@@ -664,12 +819,7 @@ async def start_handler(client: Client, message):
         await message.reply_text(f"Completed. Sent: {sent_count}, Skipped: {skipped_count}")
 
 
-@app.on_message(filters.command(["addsection", "addsections"]) & filters.private)
 async def add_section(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed. 🚫")
-        return
-
     parts = (message.text or "").split(maxsplit=1)
     if len(parts) < 2 or not parts[1].strip():
         await message.reply_text("Usage: /addsection <name> 📁")
@@ -677,29 +827,21 @@ async def add_section(client: Client, message):
 
     section = parts[1].strip()
     section_id = await store.set_section(section)
+    _cfg_cache.pop("section", None)
     if not section_id:
         await message.reply_text("Section name already exists. Try another name. 🧭")
         return
-    link = f"{settings.base_url}/section/{section_id}"
+    link = SECTION_PREFIX + section_id
     await message.reply_text(f"Section set: {section}\nOpen: {link} ✅")
 
 
-@app.on_message(filters.command("endsection") & filters.private)
 async def end_section(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed. 🚫")
-        return
-
     await store.set_section(None)
+    _cfg_cache.pop("section", None)
     await message.reply_text("Section cleared. ✅")
 
 
-@app.on_message(filters.command("delsection") & filters.private)
 async def delete_section(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed. 🚫")
-        return
-
     parts = (message.text or "").split(maxsplit=1)
     if len(parts) < 2 or not parts[1].strip():
         await message.reply_text("Usage: /delsection <name> 🗑️")
@@ -707,18 +849,14 @@ async def delete_section(client: Client, message):
 
     name = parts[1].strip()
     ok = await store.delete_section(name)
+    _cfg_cache.pop("section", None)
     if not ok:
         await message.reply_text("Section not found. 🧩")
         return
     await message.reply_text(f"Section deleted: {name} ✅")
 
 
-@app.on_message(filters.command(["showsections", "showsection", "sections"]) & filters.private)
 async def show_sections(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed. 🚫")
-        return
-
     sections = await store.list_sections()
     if not sections:
         await message.reply_text("No sections yet. 📭")
@@ -726,17 +864,12 @@ async def show_sections(client: Client, message):
 
     lines = ["Sections:"]
     for name, section_id in sections:
-        lines.append(f"{name} -> {settings.base_url}/section/{section_id}")
+        lines.append(f"{name} -> {SECTION_PREFIX}{section_id}")
     await message.reply_text("\n".join(lines))
 
 
-@app.on_message(filters.command("addadmin") & filters.private)
 async def add_admin(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed. 🚫")
-        return
-
-    parts = (message.text or "").split()
+    parts = message.command
     if len(parts) < 2:
         await message.reply_text("Usage: /addadmin <userid> 👤")
         return
@@ -752,19 +885,13 @@ async def add_admin(client: Client, message):
     await message.reply_text(f"Admin added: {user_id} ✅")
 
 
-@app.on_message(filters.command("showadminlist") & filters.private)
 async def show_admins(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed. 🚫")
-        return
-
     admins = sorted(settings.admin_ids)
     if not admins:
         await message.reply_text("No admins found. 📭")
         return
     await message.reply_text("Admins:\n" + "\n".join(str(a) for a in admins))
 
-@app.on_message(filters.command("credit") & filters.private)
 async def credit_balance(client: Client, message):
     if not message.from_user:
         await message.reply_text("Could not read your user info. Please try again. \U0001F64F")
@@ -795,9 +922,8 @@ async def credit_balance(client: Client, message):
     )
 
 
-@app.on_message(filters.command("premium") & filters.private)
 async def premium_info(client: Client, message):
-    upi_id = await store.get_upi_id()
+    upi_id = await cached_upi_id()
     if not upi_id:
         await message.reply_text("Premium payment is not configured yet. Please contact admin.")
         return
@@ -805,11 +931,10 @@ async def premium_info(client: Client, message):
     await send_payment_request_message(client, message.chat.id, req, upi_id)
 
 
-@app.on_message(filters.command("pay") & filters.private)
 async def pay_info(client: Client, message):
-    price, template = await store.get_pay_plan(DEFAULT_CREDIT_PRICE_INR, DEFAULT_PAY_TEXT)
-    upi_id = await store.get_upi_id()
-    keyboard = build_pay_keyboard()
+    price, template = await cached_pay_plan()
+    upi_id = await cached_upi_id()
+    keyboard = PAY_KEYBOARD
     parts = (message.text or "").split(maxsplit=1)
     if len(parts) >= 2:
         amount_inr = parse_amount_value(parts[1])
@@ -851,11 +976,7 @@ async def pay_info(client: Client, message):
     )
 
 
-@app.on_message(filters.command("editplan") & filters.private)
 async def edit_plan(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed. 🚫")
-        return
     parts = (message.text or "").split(maxsplit=2)
     if len(parts) < 3:
         await message.reply_text("Usage: /editplan <price> <text with {price}>")
@@ -873,6 +994,7 @@ async def edit_plan(client: Client, message):
         await message.reply_text("Text cannot be empty.")
         return
     new_price, new_text = await store.set_pay_plan(price, text)
+    _cfg_cache.pop("plan", None)
     await message.reply_text(
         "Plan updated.\n"
         f"Price: INR {new_price:.2f}\n"
@@ -880,11 +1002,7 @@ async def edit_plan(client: Client, message):
     )
 
 
-@app.on_message(filters.command("setcreditprice") & filters.private)
 async def set_credit_price(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed. 🚫")
-        return
     parts = (message.text or "").split(maxsplit=1)
     if len(parts) < 2:
         await message.reply_text("Usage: /setcreditprice <price_inr>")
@@ -893,19 +1011,16 @@ async def set_credit_price(client: Client, message):
     if value is None:
         await message.reply_text("Invalid price. Example: /setcreditprice 0.50")
         return
-    _, current_text = await store.get_pay_plan(DEFAULT_CREDIT_PRICE_INR, DEFAULT_PAY_TEXT)
+    _, current_text = await cached_pay_plan()
     new_price, _ = await store.set_pay_plan(value, current_text)
+    _cfg_cache.pop("plan", None)
     await message.reply_text(f"Credit price updated: INR {new_price:.2f}")
 
 
-@app.on_message(filters.command("setupi") & filters.private)
 async def set_upi(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed.")
-        return
     parts = (message.text or "").split(maxsplit=1)
     if len(parts) < 2:
-        current = await store.get_upi_id()
+        current = await cached_upi_id()
         if current:
             await message.reply_text(f"Current UPI ID: {current}\nUsage: /setupi <upi_id>\nClear: /setupi clear")
         else:
@@ -915,6 +1030,7 @@ async def set_upi(client: Client, message):
     raw = parts[1].strip()
     if raw.lower() in {"clear", "none", "remove"}:
         await store.set_upi_id("")
+        _cfg_cache.pop("upi", None)
         await message.reply_text("UPI ID cleared.")
         return
 
@@ -923,10 +1039,10 @@ async def set_upi(client: Client, message):
         return
 
     saved = await store.set_upi_id(raw)
+    _cfg_cache.pop("upi", None)
     await message.reply_text(f"UPI ID updated: {saved}")
 
 
-@app.on_message(filters.command("paid") & filters.private)
 async def mark_paid(client: Client, message):
     if not message.from_user:
         await message.reply_text("User not found.")
@@ -941,7 +1057,6 @@ async def mark_paid(client: Client, message):
     await message.reply_text(msg)
 
 
-@app.on_message(filters.private & filters.text & ~filters.command(KNOWN_COMMANDS))
 async def collect_pending_utr(client: Client, message):
     if not message.from_user:
         return
@@ -956,16 +1071,12 @@ async def collect_pending_utr(client: Client, message):
     await message.reply_text(msg)
 
 
-@app.on_message(filters.command("payments") & filters.private)
 async def list_payments(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed. 🚫")
-        return
-    parts = (message.text or "").split()
+    parts = message.command
     status = "all"
     limit = 20
     if len(parts) >= 2:
-        status = parts[1].strip().lower()
+        status = parts[1].lower()
     if len(parts) >= 3:
         try:
             limit = max(1, min(int(parts[2]), 100))
@@ -983,68 +1094,78 @@ async def list_payments(client: Client, message):
     await message.reply_text("\n".join(lines))
 
 
-@app.on_message(filters.command("paydb") & filters.private)
-async def export_payments_db(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed.")
-        return
+_PAYMENTS_HEADER = (
+    "request_id",
+    "user_id",
+    "amount_inr",
+    "credits",
+    "status",
+    "utr_or_note",
+    "admin_id",
+    "created_at",
+    "updated_at",
+)
+# Store request dicts always carry these keys (see TokenStore.create_payment_request).
+_payment_row = operator.itemgetter(
+    "id", "user_id", "amount_inr", "credits", "status", "note", "admin_id", "created_at", "updated_at"
+)
 
-    parts = (message.text or "").split()
+
+async def export_payments_db(client: Client, message):
+    parts = message.command
     status = "all"
     if len(parts) >= 2:
-        status = parts[1].strip().lower()
+        status = parts[1].lower()
     if status not in {"all", "pending", "submitted", "approved", "rejected", "cancelled"}:
         status = "all"
 
-    rows = await store.list_payment_requests(status=status, limit=100000)
-    if not rows:
-        await message.reply_text("No payment records found.")
-        return
+    ts_name = time.strftime("%Y%m%d-%H%M%S", time.localtime())
+    out_path = Path(tempfile.gettempdir()) / f"payments-{status}-{ts_name}.xlsx"
+    wb = xlsxwriter.Workbook(str(out_path), {"constant_memory": True})
+    ws = wb.add_worksheet("payments")
+    ws.write_row(0, 0, _PAYMENTS_HEADER)
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "payments"
-    ws.append([
-        "request_id",
-        "user_id",
-        "amount_inr",
-        "credits",
-        "status",
-        "utr_or_note",
-        "admin_id",
-        "created_at",
-        "updated_at",
-    ])
+    strftime = time.strftime
+    localtime = time.localtime
 
     def fmt_ts(value):
+        if not value:
+            return ""
         try:
-            ts = int(value or 0)
+            ts = int(value)
             if ts <= 0:
                 return ""
-            return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+            return strftime("%Y-%m-%d %H:%M:%S", localtime(ts))
         except Exception:
             return ""
 
-    for req in rows:
-        ws.append([
-            str(req.get("id", "")),
-            int(req.get("user_id", 0) or 0),
-            float(req.get("amount_inr", 0) or 0),
-            int(req.get("credits", 0) or 0),
-            str(req.get("status", "")),
-            str(req.get("note", "")),
-            int(req.get("admin_id", 0) or 0),
-            fmt_ts(req.get("created_at", 0)),
-            fmt_ts(req.get("updated_at", 0)),
-        ])
-
-    ts_name = time.strftime("%Y%m%d-%H%M%S", time.localtime())
-    out_path = Path(tempfile.gettempdir()) / f"payments-{status}-{ts_name}.xlsx"
-    wb.save(out_path)
+    write_row = ws.write_row
+    row_count = 0
+    async for req in store.iter_payment_requests(status=status, limit=100000):
+        row_count += 1
+        req_id, user_id, amount_inr, credits, req_status, note, admin_id, created_at, updated_at = _payment_row(req)
+        write_row(row_count, 0, (
+            str(req_id),
+            int(user_id or 0),
+            float(amount_inr or 0),
+            int(credits or 0),
+            str(req_status),
+            str(note),
+            int(admin_id or 0),
+            fmt_ts(created_at),
+            fmt_ts(updated_at),
+        ))
+    # Zipping the sheet XML is synchronous; keep it off the event loop.
+    await asyncio.to_thread(wb.close)
+
+    if not row_count:
+        out_path.unlink(missing_ok=True)
+        await message.reply_text("No payment records found.")
+        return
     await client.send_document(
         chat_id=message.chat.id,
         document=str(out_path),
-        caption=f"Payment export ({status}) | records: {len(rows)}",
+        caption=f"Payment export ({status}) | records: {row_count}",
     )
     try:
         out_path.unlink(missing_ok=True)
@@ -1052,11 +1173,7 @@ async def export_payments_db(client: Client, message):
         pass
 
 
-@app.on_message(filters.command("approve") & filters.private)
 async def approve_payment(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed.")
-        return
     parts = (message.text or "").split(maxsplit=2)
     if len(parts) < 2:
         await message.reply_text("Usage: /approve <request_id> [note]")
@@ -1072,11 +1189,7 @@ async def approve_payment(client: Client, message):
     await message.reply_text(msg)
 
 
-@app.on_message(filters.command("reject") & filters.private)
 async def reject_payment(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed.")
-        return
     parts = (message.text or "").split(maxsplit=2)
     if len(parts) < 2:
         await message.reply_text("Usage: /reject <request_id> [reason]")
@@ -1092,12 +1205,7 @@ async def reject_payment(client: Client, message):
     await message.reply_text(msg)
 
 
-@app.on_message(filters.command("resetpaydb") & filters.private)
 async def reset_payment_db(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed.")
-        return
-
     parts = (message.text or "").split(maxsplit=1)
     if len(parts) < 2 or parts[1].strip().lower() != "confirm":
         await message.reply_text("Usage: /resetpaydb confirm")
@@ -1107,7 +1215,6 @@ async def reset_payment_db(client: Client, message):
     await message.reply_text(f"Payment DB reset done. Removed keys/entries: {deleted}. Next request ID starts from 001.")
 
 
-@app.on_message(filters.private & filters.regex(r"^/[A-Za-z0-9_]+") & ~filters.command(KNOWN_COMMANDS))
 async def unknown_command(client: Client, message):
     await message.reply_text(
         "Unknown command. Use /start to see available commands.\n"
@@ -1115,12 +1222,7 @@ async def unknown_command(client: Client, message):
     )
 
 
-@app.on_message(filters.command("broadcast") & filters.private)
 async def broadcast_message(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed.")
-        return
-
     parts = (message.text or "").split(maxsplit=1)
     if len(parts) < 2 or not parts[1].strip():
         await message.reply_text("Usage: /broadcast <message> ℹ️")
@@ -1158,12 +1260,8 @@ async def broadcast_message(client: Client, message):
     await message.reply_text(f"Broadcast done ✅ Sent: {sent}, Failed: {failed} ❌")
 
 
-@app.on_message(filters.command("credit_add") & filters.private)
 async def credit_add(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed. 🚫")
-        return
-    parts = (message.text or "").split()
+    parts = message.command
     if len(parts) < 3:
         await message.reply_text("Usage: /credit_add <userid> <amount> 💳")
         return
@@ -1180,12 +1278,8 @@ async def credit_add(client: Client, message):
     await message.reply_text(f"Added {amount} credits to {user_id}. Balance: {balance} ✅")
 
 
-@app.on_message(filters.command("credit_remove") & filters.private)
 async def credit_remove(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed. \U0001F6AB")
-        return
-    parts = (message.text or "").split()
+    parts = message.command
     if len(parts) < 3:
         await message.reply_text("Usage: /credit_remove <userid> <amount> \U0001F9FE")
         return
@@ -1207,12 +1301,8 @@ async def credit_remove(client: Client, message):
     await message.reply_text(f"Removed {amount} credits from {user_id}. Balance: {balance} \u2705")
 
 
-@app.on_message(filters.command("db") & filters.private)
 async def credit_db(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed. 🚫")
-        return
-    parts = (message.text or "").split()
+    parts = message.command
     limit = 20
     if len(parts) >= 2:
         try:
@@ -1229,12 +1319,11 @@ async def credit_db(client: Client, message):
     await message.reply_text("\n".join(lines))
 
 
-@app.on_callback_query(filters.regex("^payamt:"))
 async def pay_amount_callback(client: Client, callback):
     if not callback.from_user or not callback.data:
         return
     value = callback.data.split(":", 1)[1].strip().lower()
-    upi_id = await store.get_upi_id()
+    upi_id = await cached_upi_id()
     if not upi_id:
         await callback.answer("Payment is not configured yet. Contact admin.", show_alert=True)
         return
@@ -1263,7 +1352,6 @@ async def pay_amount_callback(client: Client, callback):
     await callback.answer("Request created.")
 
 
-@app.on_callback_query(filters.regex("^payreq:"))
 async def payment_request_action(client: Client, callback):
     if not callback.from_user or not callback.data:
         return
@@ -1312,7 +1400,6 @@ async def payment_request_action(client: Client, callback):
     await callback.answer("Unknown action.", show_alert=True)
 
 
-@app.on_callback_query(filters.regex("^payadm:"))
 async def admin_payment_action(client: Client, callback):
     if not callback.from_user or not callback.data:
         return
@@ -1366,7 +1453,6 @@ async def admin_payment_action(client: Client, callback):
             pass
 
 
-@app.on_callback_query(filters.regex("^react:"))
 async def reaction_callback(client: Client, callback):
     if not callback.from_user or not callback.data:
         return
@@ -1377,51 +1463,54 @@ async def reaction_callback(client: Client, callback):
     action = parts[2]
     user_id = callback.from_user.id
 
-    _, _, status = await store.get_reactions(token, user_id)
     if action == "up":
-        new_reaction = 0 if status == 1 else 1
+        reaction = 1
     elif action == "down":
-        new_reaction = 0 if status == -1 else -1
+        reaction = -1
     else:
         return
 
-    likes, dislikes, status = await store.set_reaction(token, user_id, new_reaction)
+    likes, dislikes, status = await store.toggle_reaction(token, user_id, reaction)
     if callback.message:
-        await callback.message.edit_reply_markup(
-            reply_markup=build_reaction_keyboard(token, likes, dislikes, status)
-        )
+        queue_reaction_edit(callback.message, build_reaction_keyboard(token, likes, dislikes, status))
     await callback.answer("Updated")
 
 
-@app.on_message(filters.command("premiumlist") & filters.private)
-async def premium_list(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed. 🚫")
-        return
+CALLBACK_TABLE = {
+    "payamt": pay_amount_callback,
+    "payreq": payment_request_action,
+    "payadm": admin_payment_action,
+    "react": reaction_callback,
+}
+
+
+@app.on_callback_query()
+async def dispatch_callback(client: Client, callback):
+    prefix, sep, _ = (callback.data or "").partition(":")
+    handler = CALLBACK_TABLE.get(prefix) if sep else None
+    if handler is not None:
+        await handler(client, callback)
 
-    users = await db.list_premium_users()
-    if not users:
+
+async def premium_list(client: Client, message):
+    rows = await db.list_premium_users_raw()
+    if not rows:
         await message.reply_text("No premium users. 📭")
         return
 
-    lines = ["Premium users:"]
     now = int(time.time())
-    for user in users:
-        if user.expires_at is None:
-            lines.append(f"{user.user_id} (lifetime)")
-        else:
-            remaining = user.expires_at - now
-            lines.append(f"{user.user_id} (expires in {max(0, remaining)}s)")
+    lines = [
+        "Premium users:",
+        *(
+            f"{user_id} (lifetime)" if expires_at is None else f"{user_id} (expires in {max(0, expires_at - now)}s)"
+            for user_id, expires_at in rows
+        ),
+    ]
     await message.reply_text("\n".join(lines))
 
 
-@app.on_message(filters.command("history") & filters.private)
 async def history_links(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed. 🚫")
-        return
-
-    parts = (message.text or "").split()
+    parts = message.command
     limit = 20
     if len(parts) >= 2:
         try:
@@ -1429,40 +1518,28 @@ async def history_links(client: Client, message):
         except Exception:
             limit = 20
 
-    tokens = await store.list_recent(limit * 2)
-    if not tokens:
-        await message.reply_text("No history yet. 📭")
+    recent = await store.list_recent_refs(limit, scan=limit * 2)
+    if not recent:
+        # Only the empty case pays a second lookup, to tell "never posted" from "all expired".
+        if not await store.list_recent(1):
+            await message.reply_text("No history yet. 📭")
+        else:
+            await message.reply_text("No active links found (expired or missing). ⏳")
         return
 
     lines = ["Recent stream links:"]
-    shown = 0
-    for token in tokens:
-        ref = await store.get(token, settings.token_ttl_seconds)
-        if not ref:
-            continue
+    for token, ref in recent:
         link = build_link(token)
         name = ref.file_name or ref.file_unique_id or "file"
         access = "Premium" if ref.access == "premium" else "Normal"
         section = ref.section_name or "-"
         lines.append(f"{access} [{section}]: {link}\n{name}")
-        shown += 1
-        if shown >= limit:
-            break
-
-    if shown == 0:
-        await message.reply_text("No active links found (expired or missing). ⏳")
-        return
 
     await message.reply_text("\n\n".join(lines))
 
 
-@app.on_message(filters.command("add") & filters.private)
 async def add_premium_user(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed. 🚫")
-        return
-
-    parts = (message.text or "").split()
+    parts = message.command
     if len(parts) < 3:
         await message.reply_text("Usage: /add <userid> <period_days|life> 🏷️")
         return
@@ -1481,25 +1558,80 @@ async def add_premium_user(client: Client, message):
         await message.reply_text(f"Added {user_id} premium for {period} days. ✅")
 
 
-@app.on_message(filters.private & (filters.document | filters.video | filters.audio))
-async def handle_private_media(client: Client, message):
-    if not is_admin(message.from_user.id if message.from_user else None):
-        await message.reply_text("Not allowed. 🚫")
-        return
-
-    media = message.document or message.video or message.audio
-    if not media:
-        return
-
-    section_id, section_name = await store.get_section()
-    if not section_id:
-        await message.reply_text("Set a section first using /addsection <name>. 📁")
-        return
+CMD_TABLE = {
+    "start": start_handler,
+    "credit": credit_balance,
+    "premium": premium_info,
+    "pay": pay_info,
+    "paid": mark_paid,
+}
+# Commands below are answered with "Not allowed" for non-admins before the handler runs.
+ADMIN_CMD_TABLE = {
+    "addsection": add_section,
+    "addsections": add_section,
+    "endsection": end_section,
+    "delsection": delete_section,
+    "showsections": show_sections,
+    "showsection": show_sections,
+    "sections": show_sections,
+    "addadmin": add_admin,
+    "showadminlist": show_admins,
+    "editplan": edit_plan,
+    "setcreditprice": set_credit_price,
+    "setupi": set_upi,
+    "payments": list_payments,
+    "paydb": export_payments_db,
+    "approve": approve_payment,
+    "reject": reject_payment,
+    "resetpaydb": reset_payment_db,
+    "broadcast": broadcast_message,
+    "credit_add": credit_add,
+    "credit_remove": credit_remove,
+    "db": credit_db,
+    "premiumlist": premium_list,
+    "history": history_links,
+    "add": add_premium_user,
+}
+
+
+DENY_REPLY_SECONDS = 60
+
+# Non-admins already told "Not allowed"; repeats inside the window are dropped without a reply.
+_recently_denied = TTLCache(maxsize=4096, ttl=DENY_REPLY_SECONDS)
+
+
+async def deny_non_admin(message) -> None:
+    user_id = _uid(message)
+    if _recently_denied.get(user_id):
+        return
+    _recently_denied.set(user_id, True)
+    await message.reply_text("Not allowed. 🚫")
+
+
+@app.on_message(filters.private & filters.text)
+async def dispatch_private_text(client: Client, message):
+    text = message.text or ""
+    if not text.startswith("/"):
+        await collect_pending_utr(client, message)
+        return
+    # Split once here, the way filters.command does; handlers read message.command.
+    args = text.split()
+    cmd = args[0][1:].split("@", 1)[0].lower()
+    message.command = [cmd, *args[1:]]
+    handler = CMD_TABLE.get(cmd)
+    if handler is None:
+        handler = ADMIN_CMD_TABLE.get(cmd)
+        if handler is not None and not is_admin(_uid(message)):
+            await deny_non_admin(message)
+            return
+    if handler is not None:
+        await handler(client, message)
+    elif cmd not in KNOWN_COMMANDS:
+        await unknown_command(client, message)
 
-    normal_token = secrets.token_urlsafe(24)
-    premium_token = secrets.token_urlsafe(24)
 
-    base_ref = dict(
+def _media_ref(message, media, section_id: str | None, section_name: str | None) -> FileRef:
+    return FileRef(
         file_id=media.file_id,
         chat_id=message.chat.id,
         message_id=message.id,
@@ -1508,79 +1640,176 @@ async def handle_private_media(client: Client, message):
         mime_type=media.mime_type,
         file_size=media.file_size,
         media_type=message.media.value,
+        access="normal",
         created_at=time.time(),
         section_id=section_id,
         section_name=section_name,
     )
 
-    await store.set(
-        normal_token,
-        FileRef(**base_ref, access="normal"),
-        settings.token_ttl_seconds,
-    )
-    await store.set(
-        premium_token,
-        FileRef(**base_ref, access="premium"),
-        settings.token_ttl_seconds,
-    )
+
+@app.on_message(filters.private & (filters.document | filters.video | filters.audio))
+async def handle_private_media(client: Client, message):
+    if not is_admin(_uid(message)):
+        await deny_non_admin(message)
+        return
+
+    media = message.document or message.video or message.audio
+    if not media:
+        return
+
+    section_id, section_name = await cached_section()
+    if not section_id:
+        await message.reply_text("Set a section first using /addsection <name>. 📁")
+        return
+
+    normal_token, premium_token = _two_tokens()
+
+    normal_ref = _media_ref(message, media, section_id, section_name)
+    await store.set_many([
+        (normal_token, normal_ref, settings.token_ttl_seconds),
+        (premium_token, normal_ref.with_access("premium"), settings.token_ttl_seconds),
+    ])
 
     link = build_link(normal_token)
     premium_link = build_link(premium_token)
     link_text = f"Stream (Normal): {link}\nStream (Premium): {premium_link}\nSection: {section_name}"
     await message.reply_text(link_text + "\n\nReady to stream. ✅")
 
+# chat_id -> [lock, users]; an entry lives only while a reupload for that chat is running or waiting.
+_reupload_locks: dict[int, list] = {}
+
+LINK_POST_WORKERS = 4
+
+# (coroutine function, kwargs, fallback) link posts for channel uploads, drained by link_post_worker.
+# fallback is None or a (coroutine function, kwargs) pair tried when the first call fails.
+_link_post_queue: asyncio.Queue = asyncio.Queue(maxsize=256)
+
+
+async def link_post_worker() -> None:
+    while True:
+        func, kwargs, fallback = await _link_post_queue.get()
+        try:
+            try:
+                await func(**kwargs)
+            except Exception as exc:
+                if fallback is None:
+                    raise
+                # Caption too long or the post can't be edited: publish the links as a message instead.
+                logger.exception("Caption edit failed, sending message: %s", exc)
+                fallback_func, fallback_kwargs = fallback
+                await fallback_func(**fallback_kwargs)
+        except Exception as exc:
+            logger.exception("Failed to send link: %s", exc)
+        finally:
+            _link_post_queue.task_done()
+
+
+async def _reupload_and_update(client: Client, message, tokens: tuple[str, ...]) -> None:
+    # Serialised per source chat so reuploads land in the dump chat in posting order.
+    chat_id = message.chat.id
+    entry = _reupload_locks.get(chat_id)
+    if entry is None:
+        entry = _reupload_locks[chat_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            new_message = await reupload_video_as_media(client, message, settings.dump_chat_id)
+    except Exception as exc:
+        logger.exception("Failed to reupload video: %s", exc)
+        return
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _reupload_locks[chat_id]
+    if not new_message or not new_message.video:
+        return
+    video = new_message.video
+    fields = dict(
+        file_id=video.file_id,
+        chat_id=new_message.chat.id,
+        message_id=new_message.id,
+        file_unique_id=video.file_unique_id,
+        file_name=getattr(video, "file_name", None),
+        mime_type=video.mime_type,
+        file_size=video.file_size,
+        media_type=new_message.media.value,
+    )
+    await asyncio.gather(*(store.update_fields(token, **fields) for token in tokens))
+
+
+INGEST_WORKERS = 4
+
+# Channel media waiting for ingest_worker, one bounded queue per worker. A chat always hashes to the
+# same queue, so its posts are ingested (and their reuploads queued) in posting order.
+_ingest_queues: list[asyncio.Queue] = [asyncio.Queue(maxsize=32) for _ in range(INGEST_WORKERS)]
+# Posts that arrived while their shard's queue was full, in arrival order; ingest_worker moves them
+# into the queue as it frees slots, so a burst is delayed but never lost.
+_ingest_overflow: list[deque] = [deque() for _ in range(INGEST_WORKERS)]
+
+INGEST_DEDUPE_SECONDS = 5
+
+# (file_unique_id, section_id) -> (normal_token, premium_token), so a repost or redelivered update
+# inside the window reuses its tokens instead of writing new ones.
+_recent_ingests = InflightDedupe(maxsize=1024, ttl=INGEST_DEDUPE_SECONDS)
+
+
 @app.on_message(filters.channel & (filters.document | filters.video | filters.audio))
 async def handle_channel_media(client: Client, message):
     if message.outgoing:
         return
-    original_message = message
-    media = message.document or message.video or message.audio
-    if not media:
+    if not (message.document or message.video or message.audio):
         return
+    # Never blocks: waiting here would park Pyrogram's dispatcher and stall every other update.
+    shard = message.chat.id % INGEST_WORKERS
+    overflow = _ingest_overflow[shard]
+    if not overflow:
+        try:
+            _ingest_queues[shard].put_nowait(message)
+            return
+        except asyncio.QueueFull:
+            logger.warning("Ingest queue %s full, buffering channel posts", shard)
+    # Once anything is buffered, later posts queue behind it so the chat stays in posting order.
+    overflow.append(message)
 
-    logger.info("Media received chat_id=%s title=%s file_unique_id=%s", message.chat.id, message.chat.title, media.file_unique_id)
 
-    reuploaded = False
-    if settings.reupload_video and is_video_document(message) and settings.dump_chat_id:
+async def ingest_worker(client: Client, shard: int) -> None:
+    ingest_queue = _ingest_queues[shard]
+    overflow = _ingest_overflow[shard]
+    while True:
+        message = await ingest_queue.get()
+        while overflow and not ingest_queue.full():
+            ingest_queue.put_nowait(overflow.popleft())
         try:
-            new_message = await reupload_video_as_media(client, message, settings.dump_chat_id)
+            await ingest_channel_media(client, message)
         except Exception as exc:
-            logger.exception("Failed to reupload video: %s", exc)
-            new_message = None
-        if new_message and new_message.video:
-            media = new_message.video
-            message = new_message
-            reuploaded = True
+            logger.exception("Channel ingest failed: %s", exc)
+        finally:
+            ingest_queue.task_done()
 
-    normal_token = secrets.token_urlsafe(24)
-    premium_token = secrets.token_urlsafe(24)
 
-    section_id, section_name = await store.get_section()
+async def ingest_channel_media(client: Client, message) -> None:
+    media = message.document or message.video or message.audio
 
-    base_ref = dict(
-        file_id=media.file_id,
-        chat_id=message.chat.id,
-        message_id=message.id,
-        file_unique_id=media.file_unique_id,
-        file_name=getattr(media, "file_name", None),
-        mime_type=media.mime_type,
-        file_size=media.file_size,
-        media_type=message.media.value,
-        created_at=time.time(),
-        section_id=section_id,
-        section_name=section_name,
-    )
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Media received chat_id=%s title=%s file_unique_id=%s", message.chat.id, message.chat.title, media.file_unique_id)
 
-    await store.set(
-        normal_token,
-        FileRef(**base_ref, access="normal"),
-        settings.token_ttl_seconds,
-    )
-    await store.set(
-        premium_token,
-        FileRef(**base_ref, access="premium"),
-        settings.token_ttl_seconds,
-    )
+    section_id, section_name = await cached_section()
+    dedupe_key = (media.file_unique_id, section_id)
+    claim = await _recent_ingests.claim(dedupe_key, (message.chat.id, message.id), _two_tokens())
+    if claim is None:
+        return
+    fresh, (normal_token, premium_token) = claim
+    if fresh:
+        normal_ref = _media_ref(message, media, section_id, section_name)
+        try:
+            await store.set_many([
+                (normal_token, normal_ref, settings.token_ttl_seconds),
+                (premium_token, normal_ref.with_access("premium"), settings.token_ttl_seconds),
+            ])
+        except BaseException:
+            _recent_ingests.resolve(dedupe_key, False)
+            raise
+        _recent_ingests.resolve(dedupe_key, True)
 
     link = build_link(normal_token)
     premium_link = build_link(premium_token)
@@ -1590,28 +1819,20 @@ async def handle_channel_media(client: Client, message):
         new_caption = f"{caption}\n\n{link_text}"
     else:
         new_caption = link_text
-    try:
-        if settings.send_link_as_message:
-            await client.send_message(chat_id=original_message.chat.id, text=link_text)
-            return
-        if reuploaded:
-            try:
-                await client.edit_message_caption(
-                    chat_id=original_message.chat.id,
-                    message_id=original_message.id,
-                    caption=new_caption,
-                )
-            except Exception as exc:
-                logger.exception("Caption edit failed, sending message: %s", exc)
-                await client.send_message(chat_id=original_message.chat.id, text=link_text)
-        else:
-            await client.edit_message_caption(
-                chat_id=message.chat.id,
-                message_id=message.id,
-                caption=new_caption,
-            )
-    except Exception as exc:
-        logger.exception("Failed to send link: %s", exc)
+    if fresh and settings.reupload_video and is_video_document(message) and settings.dump_chat_id:
+        task = asyncio.create_task(_reupload_and_update(client, message, (normal_token, premium_token)))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+    # Only blocks when the queue is full, which throttles a burst instead of dropping posts.
+    if settings.send_link_as_message:
+        await _link_post_queue.put((client.send_message, {"chat_id": message.chat.id, "text": link_text}, None))
+    else:
+        await _link_post_queue.put((
+            client.edit_message_caption,
+            {"chat_id": message.chat.id, "message_id": message.id, "caption": new_caption},
+            (client.send_message, {"chat_id": message.chat.id, "text": link_text}),
+        ))
 
 
 async def notify_admin_restart(client: Client) -> None:
@@ -1627,12 +1848,15 @@ async def notify_admin_restart(client: Client) -> None:
 
 
 async def runner() -> None:
+    # Handlers log from the event loop; hand records to a queue and let a listener thread do the
+    # blocking stderr writes. Set up here rather than at import so importing the module leaves logging alone.
+    root_logger = logging.getLogger()
+    log_listener = logging.handlers.QueueListener(queue.SimpleQueue(), *root_logger.handlers, respect_handler_level=True)
+    root_logger.handlers = [logging.handlers.QueueHandler(log_listener.queue)]
+    log_listener.start()
     await store.connect()
     await db.connect()
-    for admin_id in settings.admin_ids:
-        await db.add_admin(admin_id)
-    admins = await db.list_admins()
-    settings.admin_ids.update(admins)
+    settings.admin_ids.update(await db.seed_admins(tuple(settings.admin_ids)))
     while True:
         try:
             await app.start()
@@ -1643,12 +1867,21 @@ async def runner() -> None:
         except FloodWait as exc:
             logger.warning("FloodWait %s seconds", exc.value)
             await asyncio.sleep(exc.value)
+    delete_task = asyncio.create_task(delete_scheduler.run(app))
+    worker_tasks = [asyncio.create_task(link_post_worker()) for _ in range(LINK_POST_WORKERS)]
+    worker_tasks += [asyncio.create_task(ingest_worker(app, shard)) for shard in range(INGEST_WORKERS)]
     try:
-        await asyncio.Event().wait()
+        # Returns on SIGINT/SIGTERM, so a container stop runs the cleanup below instead of killing it.
+        await idle()
     finally:
+        delete_task.cancel()
+        for task in worker_tasks:
+            task.cancel()
         await app.stop()
         await store.close()
         await db.close()
+        log_listener.stop()
+        root_logger.handlers = list(log_listener.handlers)
 
 
 if __name__ == "__main__":
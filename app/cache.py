@@ -0,0 +1,79 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """
+    Bounded LRU mapping whose entries expire ``ttl`` seconds after they were stored.
+    Expired entries are dropped lazily on access; the oldest entry is evicted past ``maxsize``.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 60.0) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        if time.monotonic() - entry[0] >= self.ttl:
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class InflightDedupe:
+    """
+    Remembers, for ``ttl`` seconds, the value written for a key by its first owner, so a duplicate
+    from another owner reuses it instead of writing a new one.
+    claim() returns None when ``owner`` already holds the key (a redelivery: nothing to do),
+    (False, value) with the first owner's stored value, or (True, value) when the caller now owns
+    the key and must store ``value`` and then call resolve(). Duplicates that arrive while the owner
+    is still writing wait for resolve(); if the write failed they claim the key afresh.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 5.0) -> None:
+        self._pending: dict[Hashable, tuple[Hashable, Any, asyncio.Future]] = {}
+        self._done = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def claim(self, key: Hashable, owner: Hashable, value: Any) -> Optional[tuple[bool, Any]]:
+        while True:
+            pending = self._pending.get(key)
+            if pending is None:
+                break
+            pending_owner, pending_value, stored = pending
+            if pending_owner == owner:
+                return None
+            if await asyncio.shield(stored):
+                return False, pending_value
+        done = self._done.get(key)
+        if done is not None:
+            return None if done[0] == owner else (False, done[1])
+        self._pending[key] = (owner, value, asyncio.get_running_loop().create_future())
+        return True, value
+
+    def resolve(self, key: Hashable, ok: bool) -> None:
+        owner, value, stored = self._pending.pop(key)
+        if ok:
+            self._done.set(key, (owner, value))
+        stored.set_result(ok)
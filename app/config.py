@@ -1,5 +1,6 @@
 import os
 from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -31,6 +32,8 @@ class Settings:
     stream_password: str
     history_limit: int
     auto_delete_seconds: int   # 0 = disabled
+    tmp_dir: str | None        # None = system temp dir
+    reupload_concurrency: int
 
 
 def _parse_admin_ids(value: str) -> set[int]:
@@ -46,6 +49,9 @@ def _parse_admin_ids(value: str) -> set[int]:
     return ids
 
 
+# Parsed once per process; every module shares the same instance, so a runtime change such as
+# settings.admin_ids.add() is seen by all of them.
+@lru_cache(maxsize=1)
 def get_settings() -> Settings:
     api_id = int(os.getenv("API_ID", "0"))
     api_hash = os.getenv("API_HASH", "")
@@ -67,6 +73,8 @@ def get_settings() -> Settings:
     stream_password = os.getenv("STREAM_PASSWORD", "")
     history_limit = int(os.getenv("HISTORY_LIMIT", "200"))
     auto_delete_seconds = int(os.getenv("AUTO_DELETE_SECONDS", "0"))
+    tmp_dir = os.getenv("TMP_DIR", "").strip() or None
+    reupload_concurrency = max(1, int(os.getenv("REUPLOAD_CONCURRENCY", "3")))
     dump_chat_id_raw = os.getenv("DUMP_CHAT_ID", "").strip()
     dump_chat_id_val: int | str | None = None
     if dump_chat_id_raw:
@@ -96,6 +104,8 @@ def get_settings() -> Settings:
         raise SystemExit("CHUNK_SIZE must be between 262144 and 524288 bytes.")
 
     Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    if tmp_dir:
+        Path(tmp_dir).mkdir(parents=True, exist_ok=True)
 
     return Settings(
         api_id=api_id,
@@ -120,4 +130,6 @@ def get_settings() -> Settings:
         stream_password=stream_password,
         history_limit=history_limit,
         auto_delete_seconds=auto_delete_seconds,
+        tmp_dir=tmp_dir,
+        reupload_concurrency=reupload_concurrency,
     )
@@ -1,8 +1,20 @@
+import asyncio
+import sqlite3
 import time
 from dataclasses import dataclass
-from typing import Optional
+from pathlib import Path
+from typing import Any, Callable, Iterable, Optional, TypeVar
 
-import aiosqlite
+from app.cache import TTLCache
+
+
+T = TypeVar("T")
+
+PREMIUM_CACHE_SECONDS = 30
+
+_SQL_GET_EXPIRY = "SELECT expires_at FROM premium_users WHERE user_id = ?"
+_SQL_SET_EXPIRY = "INSERT OR REPLACE INTO premium_users (user_id, expires_at) VALUES (?, ?)"
+_SQL_ADD_ADMIN = "INSERT OR REPLACE INTO admins (user_id) VALUES (?)"
 
 
 @dataclass
@@ -14,11 +26,26 @@ class PremiumUser:
 class PremiumDB:
     def __init__(self, db_path: str) -> None:
         self.db_path = db_path
-        self._conn: Optional[aiosqlite.Connection] = None
+        # Writer (used from worker threads) and a separate read-only connection used inline, so a
+        # read never queues behind a write holding the writer's connection mutex.
+        self._conn: Optional[sqlite3.Connection] = None
+        self._reader: Optional[sqlite3.Connection] = None
+        # Serialises every use of the writer connection from worker threads; inline reads never take it.
+        self._conn_lock = asyncio.Lock()
+        # user_id -> (has_row, expires_at) of active plans only; is_premium runs on every stream request,
+        # so a premium user's row is served from here and dropped on add_user/set_expiry.
+        self._premium_cache = TTLCache(maxsize=4096, ttl=PREMIUM_CACHE_SECONDS)
 
     async def connect(self) -> None:
-        self._conn = await aiosqlite.connect(self.db_path)
-        await self._conn.execute(
+        # Plain sqlite3 in autocommit mode. Primary-key point reads run inline on the loop instead of
+        # paying aiosqlite's per-call thread hop; writes (which may fsync) and whole-table scans (which
+        # can fault in many cold mmap pages) go to a worker thread via _run.
+        self._conn = self._open(self.db_path)
+        # WAL lets readers proceed while a write commits; NORMAL skips the per-commit fsync WAL doesn't need.
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.execute(
             """
             CREATE TABLE IF NOT EXISTS premium_users (
                 user_id INTEGER PRIMARY KEY,
@@ -26,14 +53,14 @@ class PremiumDB:
             )
             """
         )
-        await self._conn.execute(
+        self._conn.execute(
             """
             CREATE TABLE IF NOT EXISTS admins (
                 user_id INTEGER PRIMARY KEY
             )
             """
         )
-        await self._conn.execute(
+        self._conn.execute(
             """
             CREATE TABLE IF NOT EXISTS bot_users (
                 user_id INTEGER PRIMARY KEY,
@@ -43,83 +70,144 @@ class PremiumDB:
             )
             """
         )
-        await self._conn.commit()
+        if self.db_path in ("", ":memory:"):
+            # A private in-memory database exists only inside the writer's connection.
+            self._reader = self._conn
+            return
+        # Opened only once the writer has switched the file to WAL and created the schema;
+        # mode=ro rejects writes outright, and in WAL it reads a snapshot without blocking the writer.
+        self._reader = self._open(Path(self.db_path).resolve().as_uri() + "?mode=ro", uri=True)
+        # Reads on this connection run on the event loop, so never wait there: a busy database
+        # (WAL recovery, checkpoint) raises at once and _read_one retries on the worker thread.
+        self._reader.execute("PRAGMA busy_timeout=0")
+
+    @staticmethod
+    def _open(database: str, uri: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            database,
+            uri=uri,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=256,
+        )
+        # Temp b-trees in RAM and reads served from a 256 MB mmap instead of read() syscalls.
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        # Wait out a concurrent writer instead of failing with SQLITE_BUSY; ~20 MB page cache.
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA cache_size=-20000")
+        return conn
 
     async def close(self) -> None:
+        if self._reader is not None and self._reader is not self._conn:
+            self._reader.close()
+        self._reader = None
         if self._conn is not None:
-            await self._conn.close()
+            async with self._conn_lock:
+                self._conn.close()
+            self._conn = None
+
+    async def _run(self, func: Callable[..., T], *args: Any) -> T:
+        async with self._conn_lock:
+            return await asyncio.to_thread(func, *args)
+
+    def _fetchall(self, sql: str, params: tuple[Any, ...] = ()) -> list[tuple]:
+        return self._conn.execute(sql, params).fetchall()
+
+    async def _read_one(self, sql: str, params: tuple[Any, ...]) -> Optional[tuple]:
+        try:
+            return self._reader.execute(sql, params).fetchone()
+        except sqlite3.OperationalError as exc:
+            if exc.sqlite_errorcode & 0xFF != sqlite3.SQLITE_BUSY:
+                raise
+        rows = await self._run(self._fetchall, sql, params)
+        return rows[0] if rows else None
+
+    async def _write(self, sql: str, params: tuple[Any, ...]) -> None:
+        await self._run(self._conn.execute, sql, params)
 
     async def add_bot_user(self, user_id: int, username: Optional[str] = None, first_name: Optional[str] = None) -> None:
-        await self._conn.execute(
+        await self._write(
             "INSERT OR IGNORE INTO bot_users (user_id, username, first_name, joined_at) VALUES (?, ?, ?, ?)",
             (user_id, username, first_name, int(time.time())),
         )
-        await self._conn.commit()
 
     async def list_bot_users(self) -> list[int]:
-        cursor = await self._conn.execute("SELECT user_id FROM bot_users")
-        rows = await cursor.fetchall()
+        rows = await self._run(self._fetchall, "SELECT user_id FROM bot_users")
         return [row[0] for row in rows]
 
     async def add_user(self, user_id: int, period_days: Optional[int]) -> None:
         expires_at = None
         if period_days is not None:
             expires_at = int(time.time()) + period_days * 86400
-        await self._conn.execute(
-            "INSERT OR REPLACE INTO premium_users (user_id, expires_at) VALUES (?, ?)",
-            (user_id, expires_at),
-        )
-        await self._conn.commit()
+        await self._write(_SQL_SET_EXPIRY, (user_id, expires_at))
+        self._premium_cache.pop(user_id)
 
     async def set_expiry(self, user_id: int, expires_at: Optional[int]) -> None:
-        await self._conn.execute(
-            "INSERT OR REPLACE INTO premium_users (user_id, expires_at) VALUES (?, ?)",
-            (int(user_id), None if expires_at is None else int(expires_at)),
-        )
-        await self._conn.commit()
+        await self._write(_SQL_SET_EXPIRY, (int(user_id), None if expires_at is None else int(expires_at)))
+        self._premium_cache.pop(int(user_id))
 
     async def get_expiry(self, user_id: int) -> Optional[int]:
-        cursor = await self._conn.execute(
-            "SELECT expires_at FROM premium_users WHERE user_id = ?",
-            (int(user_id),),
-        )
-        row = await cursor.fetchone()
+        row = await self._read_one(_SQL_GET_EXPIRY, (int(user_id),))
         if not row:
             return None
         value = row[0]
         return None if value is None else int(value)
 
-    async def is_premium(self, user_id: int) -> bool:
-        cursor = await self._conn.execute(
-            "SELECT expires_at FROM premium_users WHERE user_id = ?",
-            (user_id,),
-        )
-        row = await cursor.fetchone()
+    async def _load_premium(self, user_id: int) -> tuple[bool, Optional[int]]:
+        row = await self._read_one(_SQL_GET_EXPIRY, (user_id,))
         if not row:
-            return False
-        expires_at = row[0]
-        if expires_at is None:
-            return True
-        return int(time.time()) <= int(expires_at)
+            return False, None
+        return True, row[0]
 
+    async def is_premium(self, user_id: int) -> bool:
+        # The expiry is cached rather than the verdict, so a plan lapsing mid-TTL still takes effect.
+        # Misses are never cached: other processes share this database, and a grant made in one of them
+        # must apply at once, not after this process's cached entry expires.
+        entry = self._premium_cache.get(user_id)
+        cached = entry is not None
+        if not cached:
+            entry = await self._load_premium(user_id)
+        has_row, expires_at = entry
+        if not has_row or (expires_at is not None and int(time.time()) > int(expires_at)):
+            if cached:
+                self._premium_cache.pop(user_id)
+            return False
+        if not cached:
+            self._premium_cache.set(user_id, entry)
+        return True
 
     async def list_premium_users(self) -> list[PremiumUser]:
-        cursor = await self._conn.execute(
-            "SELECT user_id, expires_at FROM premium_users ORDER BY user_id"
-        )
-        rows = await cursor.fetchall()
+        rows = await self._run(self._fetchall, "SELECT user_id, expires_at FROM premium_users ORDER BY user_id")
         return [PremiumUser(user_id=row[0], expires_at=row[1]) for row in rows]
 
+    async def list_premium_users_raw(self) -> list[tuple[int, Optional[int]]]:
+        return await self._run(self._fetchall, "SELECT user_id, expires_at FROM premium_users ORDER BY user_id")
+
     async def add_admin(self, user_id: int) -> None:
-        await self._conn.execute(
-            "INSERT OR REPLACE INTO admins (user_id) VALUES (?)",
-            (user_id,),
-        )
-        await self._conn.commit()
+        await self._write(_SQL_ADD_ADMIN, (user_id,))
+
+    def _write_admins(self, rows: list[tuple[int]]) -> None:
+        # One transaction, so seeding N admins costs one commit (and WAL sync) instead of N.
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.executemany(_SQL_ADD_ADMIN, rows)
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    async def add_admins_bulk(self, user_ids: Iterable[int]) -> None:
+        rows = [(int(user_id),) for user_id in user_ids]
+        if not rows:
+            return
+        await self._run(self._write_admins, rows)
+
+    async def seed_admins(self, user_ids: Iterable[int]) -> list[int]:
+        # Returns every admin in the table, the configured ids plus any added at runtime via /addadmin.
+        await self.add_admins_bulk(user_ids)
+        return await self.list_admins()
 
     async def list_admins(self) -> list[int]:
-        cursor = await self._conn.execute(
-            "SELECT user_id FROM admins ORDER BY user_id"
-        )
-        rows = await cursor.fetchall()
+        rows = await self._run(self._fetchall, "SELECT user_id FROM admins ORDER BY user_id")
         return [row[0] for row in rows]
@@ -1,12 +1,14 @@
 import time
-from typing import Optional
+from typing import Iterable, Optional
 
 from app.db import PremiumDB, PremiumUser
 
 try:
     from motor.motor_asyncio import AsyncIOMotorClient
+    from pymongo import UpdateOne
 except Exception:
     AsyncIOMotorClient = None
+    UpdateOne = None
 
 
 class MongoPremiumDB(PremiumDB):
@@ -65,6 +67,7 @@ class MongoPremiumDB(PremiumDB):
             {"$set": {"expires_at": expires_at}},
             upsert=True,
         )
+        self._premium_cache.pop(user_id)
 
     async def set_expiry(self, user_id: int, expires_at: Optional[int]) -> None:
         await self._premium.update_one(
@@ -72,6 +75,7 @@ class MongoPremiumDB(PremiumDB):
             {"$set": {"expires_at": None if expires_at is None else int(expires_at)}},
             upsert=True,
         )
+        self._premium_cache.pop(int(user_id))
 
     async def get_expiry(self, user_id: int) -> Optional[int]:
         row = await self._premium.find_one({"_id": int(user_id)}, {"expires_at": 1})
@@ -80,14 +84,11 @@ class MongoPremiumDB(PremiumDB):
         value = row.get("expires_at")
         return None if value is None else int(value)
 
-    async def is_premium(self, user_id: int) -> bool:
+    async def _load_premium(self, user_id: int) -> tuple[bool, Optional[int]]:
         row = await self._premium.find_one({"_id": int(user_id)}, {"expires_at": 1})
         if not row:
-            return False
-        expires_at = row.get("expires_at")
-        if expires_at is None:
-            return True
-        return int(time.time()) <= int(expires_at)
+            return False, None
+        return True, row.get("expires_at")
 
     async def list_premium_users(self) -> list[PremiumUser]:
         rows: list[PremiumUser] = []
@@ -96,6 +97,10 @@ class MongoPremiumDB(PremiumDB):
             rows.append(PremiumUser(user_id=int(row["_id"]), expires_at=row.get("expires_at")))
         return rows
 
+    async def list_premium_users_raw(self) -> list[tuple[int, Optional[int]]]:
+        cursor = self._premium.find({}, {"expires_at": 1}).sort("_id", 1)
+        return [(int(row["_id"]), row.get("expires_at")) async for row in cursor]
+
     async def add_admin(self, user_id: int) -> None:
         await self._admins.update_one(
             {"_id": int(user_id)},
@@ -103,6 +108,15 @@ class MongoPremiumDB(PremiumDB):
             upsert=True,
         )
 
+    async def add_admins_bulk(self, user_ids: Iterable[int]) -> None:
+        now = int(time.time())
+        ops = [
+            UpdateOne({"_id": int(user_id)}, {"$set": {"created_at": now}}, upsert=True)
+            for user_id in user_ids
+        ]
+        if ops:
+            await self._admins.bulk_write(ops, ordered=False)
+
     async def list_admins(self) -> list[int]:
         admins: list[int] = []
         cursor = self._admins.find({}, {"_id": 1}).sort("_id", 1)
@@ -1,19 +1,20 @@
+import asyncio
 import secrets
 import time
-from dataclasses import asdict
 from typing import Optional
 
-from app.store import FileRef, TokenStore, _normalize_section, _slugify
+from app.store import FileRef, TokenStore, _normalize_section, _ref_fields, _slugify
 
 try:
     from motor.motor_asyncio import AsyncIOMotorClient
-    from pymongo import ASCENDING, DESCENDING, ReturnDocument
+    from pymongo import ASCENDING, DESCENDING, ReplaceOne, ReturnDocument
     from pymongo.errors import DuplicateKeyError
 except Exception:
     AsyncIOMotorClient = None
     ASCENDING = 1
     DESCENDING = -1
     ReturnDocument = None
+    ReplaceOne = None
     DuplicateKeyError = Exception
 
 
@@ -142,12 +143,23 @@ class MongoTokenStore(TokenStore):
         }
 
     async def set(self, token: str, ref: FileRef, ttl_seconds: int) -> None:
-        doc = {"_id": token, **asdict(ref)}
+        doc = {"_id": token, **_ref_fields(ref)}
         if ttl_seconds and ttl_seconds > 0:
             doc["expires_at"] = float(ref.created_at) + int(ttl_seconds)
         await self._tokens.replace_one({"_id": token}, doc, upsert=True)
 
-    async def get(self, token: str, ttl_seconds: int) -> Optional[FileRef]:
+    async def set_many(self, items: list[tuple[str, FileRef, int]]) -> None:
+        if not items:
+            return
+        ops = []
+        for token, ref, ttl_seconds in items:
+            doc = {"_id": token, **_ref_fields(ref)}
+            if ttl_seconds and ttl_seconds > 0:
+                doc["expires_at"] = float(ref.created_at) + int(ttl_seconds)
+            ops.append(ReplaceOne({"_id": token}, doc, upsert=True))
+        await self._tokens.bulk_write(ops, ordered=False)
+
+    async def get(self, token: str) -> Optional[FileRef]:
         doc = await self._tokens.find_one({"_id": token})
         if not doc:
             return None
@@ -157,7 +169,7 @@ class MongoTokenStore(TokenStore):
             return None
         return self._token_doc_to_ref(doc)
 
-    async def get_many(self, tokens: list[str], ttl_seconds: int) -> dict[str, FileRef]:
+    async def get_many(self, tokens: list[str]) -> dict[str, FileRef]:
         ordered = [str(token) for token in tokens if token]
         if not ordered:
             return {}
@@ -180,11 +192,21 @@ class MongoTokenStore(TokenStore):
             await self._tokens.delete_many({"_id": {"$in": expired}})
         return results
 
+    async def update_fields(self, token: str, **fields) -> bool:
+        result = await self._tokens.update_one({"_id": token}, {"$set": fields})
+        return result.matched_count > 0
+
     async def list_recent(self, limit: int) -> list[str]:
         limit = max(int(limit), 1)
         cursor = self._tokens.find(self._live_filter(), {"_id": 1}).sort("created_at", DESCENDING).limit(limit)
         return [str(doc["_id"]) async for doc in cursor]
 
+    async def list_recent_refs(self, limit: int, scan: Optional[int] = None) -> list[tuple[str, FileRef]]:
+        limit = max(int(limit), 1)
+        tokens = await self.list_recent(max(int(scan or limit), limit))
+        refs = await self.get_many(tokens)
+        return [(token, refs[token]) for token in tokens if token in refs][:limit]
+
     async def increment_view(self, token: str, viewer_id: Optional[str], ttl_seconds: int) -> tuple[int, int]:
         doc = await self._token_metrics.find_one_and_update(
             {"_id": token},
@@ -294,15 +316,24 @@ class MongoTokenStore(TokenStore):
         return int(total), bool(user_liked)
 
     async def get_reactions(self, token: str, user_id: Optional[int] = None) -> tuple[int, int, int]:
-        likes = await self._token_reactions.count_documents({"token": token, "reaction": 1})
-        dislikes = await self._token_reactions.count_documents({"token": token, "reaction": -1})
-        status = 0
-        if user_id is not None:
-            row = await self._token_reactions.find_one({"token": token, "user_id": int(user_id)}, {"reaction": 1})
-            if row:
-                status = int(row.get("reaction", 0) or 0)
+        likes, dislikes, row = await asyncio.gather(
+            self._token_reactions.count_documents({"token": token, "reaction": 1}),
+            self._token_reactions.count_documents({"token": token, "reaction": -1}),
+            self._token_reactions.find_one({"token": token, "user_id": int(user_id)}, {"reaction": 1})
+            if user_id is not None
+            else asyncio.sleep(0),
+        )
+        status = int(row.get("reaction", 0) or 0) if row else 0
         return int(likes), int(dislikes), status
 
+    async def toggle_reaction(self, token: str, user_id: int, reaction: int) -> tuple[int, int, int]:
+        removed = await self._token_reactions.delete_one(
+            {"token": token, "user_id": int(user_id), "reaction": int(reaction)}
+        )
+        if removed.deleted_count:
+            return await self.get_reactions(token, user_id)
+        return await self.set_reaction(token, user_id, reaction)
+
     async def set_reaction(self, token: str, user_id: int, reaction: int) -> tuple[int, int, int]:
         if reaction in {1, -1}:
             await self._token_reactions.update_one(
@@ -762,6 +793,34 @@ class MongoTokenStore(TokenStore):
         )
         return self._payment_doc_to_dict(doc)
 
+    async def finalize_payment(
+        self,
+        request_id: str,
+        user_id: int,
+        credits: int,
+        status: str,
+        note: str = "",
+        admin_id: int = 0,
+        append_balance: bool = False,
+        clear_utr: bool = True,
+    ) -> int:
+        clear = self.clear_pending_utr(user_id) if clear_utr else asyncio.sleep(0)
+        if append_balance:
+            # The note needs the new balance, so crediting has to land first.
+            balance = await (self.add_credits(user_id, credits) if int(credits) else self.get_credits(user_id))
+            note = f"{str(note or '').strip()} {balance}"
+            await asyncio.gather(
+                self.set_payment_request_status(request_id, status, note=note, admin_id=admin_id),
+                clear,
+            )
+            return balance
+        balance, _, _ = await asyncio.gather(
+            self.add_credits(user_id, credits) if int(credits) else self.get_credits(user_id),
+            self.set_payment_request_status(request_id, status, note=note, admin_id=admin_id),
+            clear,
+        )
+        return balance
+
     async def transition_payment_request_status(
         self,
         request_id: str,
@@ -821,6 +880,20 @@ class MongoTokenStore(TokenStore):
                 rows.append(item)
         return rows
 
+    async def iter_payment_requests(self, status: str = "all", limit: int = 100000, batch_size: int = 500):
+        status = (status or "all").strip().lower()
+        query = {} if status == "all" else {"status": status}
+        cursor = (
+            self._payment_requests.find(query)
+            .sort("created_at", DESCENDING)
+            .limit(max(1, int(limit)))
+            .batch_size(max(1, int(batch_size)))
+        )
+        async for row in cursor:
+            item = self._payment_doc_to_dict(row)
+            if item:
+                yield item
+
     async def get_user_active_payment_request(
         self,
         user_id: int,
@@ -1044,6 +1117,17 @@ class MongoTokenStore(TokenStore):
         cursor = self._tokens.find(self._live_filter({"section_id": section_id}), {"_id": 1}).sort("created_at", DESCENDING).limit(limit)
         return [str(row["_id"]) async for row in cursor]
 
+    async def list_section_refs(
+        self, section_id: str, limit: int, access: Optional[str] = None
+    ) -> list[tuple[str, FileRef]]:
+        limit = max(int(limit), 1)
+        extra = {"section_id": section_id}
+        access = (access or "").strip().lower()
+        if access:
+            extra["access"] = access
+        cursor = self._tokens.find(self._live_filter(extra)).sort("created_at", DESCENDING).limit(limit)
+        return [(str(doc["_id"]), self._token_doc_to_ref(doc)) async for doc in cursor]
+
     async def create_poll(self, poll_id: str, media_type: str, file_id: Optional[str], caption: Optional[str], text: Optional[str], options: list[str]) -> None:
         await self._polls_col.update_one(
             {"_id": poll_id},
@@ -0,0 +1,78 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class _Bucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def reserve(self, now: float) -> float:
+        """Take one token and return how long the caller must wait before using it."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class RateLimiter:
+    """
+    Token buckets for outbound Telegram calls: one global, one per chat.
+    Tokens are reserved synchronously (no await between read and write, so no lock is needed)
+    and the wait happens afterwards, so callers for different chats sleep concurrently.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 25,
+        global_burst: int = 30,
+        chat_rate: float = 1,
+        chat_burst: int = 1,
+        max_chats: int = 4096,
+        flood_error: Optional[type[Exception]] = None,
+        max_retries: int = 3,
+    ) -> None:
+        self._global = _Bucket(global_rate, global_burst)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_chats = max_chats
+        self._chats: OrderedDict[int, _Bucket] = OrderedDict()
+        self._flood_error = flood_error
+        self._max_retries = max_retries
+
+    async def acquire(self, chat_id: int) -> None:
+        now = time.monotonic()
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = _Bucket(self._chat_rate, self._chat_burst)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > self._max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        wait = max(bucket.reserve(now), self._global.reserve(now))
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def send(self, factory: Callable[[], Awaitable[T]], chat_id: int) -> T:
+        """Run ``factory()`` once both buckets allow it, retrying after flood errors."""
+        attempt = 0
+        while True:
+            await self.acquire(chat_id)
+            try:
+                return await factory()
+            except Exception as exc:
+                if self._flood_error is None or not isinstance(exc, self._flood_error) or attempt >= self._max_retries:
+                    raise
+                attempt += 1
+                await asyncio.sleep(getattr(exc, "value", 1) or 1)
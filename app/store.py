@@ -1,7 +1,15 @@
+import asyncio
+import base64
+import heapq
 import json
+import os
+import re
 import secrets
 import time
-from dataclasses import asdict, dataclass
+from collections import deque
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from itertools import islice
 from typing import Optional
 
 try:
@@ -14,8 +22,19 @@ try:
 except Exception:
     WatchError = Exception
 
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+
+REDIS_MAX_CONNECTIONS = 50
+# Seconds a command waits for a free pooled connection before raising.
+REDIS_POOL_TIMEOUT = 10
+REDIS_WARM_CONNECTIONS = 8
 
-@dataclass
+
+@dataclass(frozen=True, slots=True)
 class FileRef:
     file_id: str
     chat_id: int
@@ -31,23 +50,102 @@ class FileRef:
     section_name: Optional[str] = None
     dl_token: Optional[str] = None
 
+    def with_access(self, access: str, **changes) -> "FileRef":
+        return replace(self, access=access, **changes)
+
+
+# Compact on-wire field names for FileRef payloads. Readers accept both spellings, so records
+# written before the switch still decode.
+_SHORT_KEYS = {
+    "access": "x",
+    "file_id": "i",
+    "chat_id": "c",
+    "message_id": "m",
+    "file_unique_id": "u",
+    "file_name": "n",
+    "mime_type": "t",
+    "file_size": "z",
+    "media_type": "k",
+    "created_at": "a",
+    "section_id": "s",
+    "section_name": "sn",
+    "dl_token": "d",
+}
+_LONG_KEYS = {short: name for name, short in _SHORT_KEYS.items()}
+_REF_DEFAULTS = {
+    "file_id": "",
+    "access": "normal",
+    "file_name": None,
+    "mime_type": None,
+    "file_size": None,
+    "section_id": None,
+    "section_name": None,
+}
+
+
+def _ref_fields(ref: FileRef) -> dict:
+    # Shallow field read; every FileRef field is a scalar, so asdict's recursive deepcopy is wasted.
+    return {name: getattr(ref, name) for name in _SHORT_KEYS}
+
+
+def _ref_dumps(data: FileRef | dict) -> str | bytes:
+    if isinstance(data, FileRef):
+        short = {key: value for name, key in _SHORT_KEYS.items() if (value := getattr(data, name)) is not None}
+    else:
+        short = {_SHORT_KEYS.get(name, name): value for name, value in data.items() if value is not None}
+    if orjson is not None:
+        return orjson.dumps(short)
+    return json.dumps(short)
+
+
+@lru_cache(maxsize=4096)
+def _ref_from_json(raw: str | bytes) -> FileRef:
+    # Keyed on the stored payload itself, so a rewritten token simply misses; FileRef is frozen
+    # so the same instance can be handed to every caller.
+    data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    return FileRef(**{**_REF_DEFAULTS, **{_LONG_KEYS.get(key, key): value for key, value in data.items()}})
+
+
+class TokenPool:
+    """Hands out secrets.token_urlsafe(24)-shaped tokens cut from one large urandom read."""
+
+    def __init__(self, batch: int = 256) -> None:
+        self._batch = batch
+        self._buf: list[str] = []
+
+    def take(self) -> str:
+        if not self._buf:
+            # 24 random bytes encode to exactly 32 unpadded chars, so the slices never straddle tokens.
+            raw = base64.urlsafe_b64encode(os.urandom(24 * self._batch)).decode()
+            self._buf = [raw[i:i + 32] for i in range(0, len(raw), 32)]
+        return self._buf.pop()
+
+
+token_pool = TokenPool()
+
 
 def _normalize_section(value: str) -> str:
     return " ".join(value.strip().lower().split())
 
 
+class _SlugTable(dict):
+    """
+    str.translate table mapping every non-alphanumeric code point to "-".
+    Filled on first sight of each code point, so non-ASCII letters stay exactly as isalnum() treats them.
+    """
+
+    def __missing__(self, code: int) -> int | str:
+        value = code if chr(code).isalnum() else "-"
+        self[code] = value
+        return value
+
+
+_SLUG_TABLE = _SlugTable()
+_SLUG_DASHES = re.compile(r"-{2,}")
+
+
 def _slugify(value: str) -> str:
-    cleaned = []
-    last_dash = False
-    for ch in value.strip().lower():
-        if ch.isalnum():
-            cleaned.append(ch)
-            last_dash = False
-        else:
-            if not last_dash:
-                cleaned.append("-")
-                last_dash = True
-    slug = "".join(cleaned).strip("-")
+    slug = _SLUG_DASHES.sub("-", value.strip().lower().translate(_SLUG_TABLE)).strip("-")
     return slug or "section"
 
 
@@ -55,9 +153,15 @@ class TokenStore:
     def __init__(self, redis_url: Optional[str] = None, history_limit: int = 200) -> None:
         self._redis_url = redis_url
         self._redis = None
+        self._pool = None
         self._memory: dict[str, FileRef] = {}
-        self._history: list[str] = []
-        self._sections: dict[str, list[str]] = {}
+        # Memory mode only: absolute expiry per token plus a min-heap of (expires_at, token), so
+        # reads are a plain dict lookup and expired tokens are swept from the heap head.
+        self._memory_expires: dict[str, float] = {}
+        self._expiry_heap: list[tuple[float, str]] = []
+        # Bounded deques: appendleft is O(1) and maxlen drops the oldest entry, no trim copy.
+        self._history: deque[str] = deque(maxlen=max(history_limit, 1))
+        self._sections: dict[str, deque[str]] = {}
         self._section_registry: dict[str, str] = {}
         self._section_registry_id: dict[str, str] = {}
         self._public_sections: dict[str, str] = {}
@@ -125,121 +229,184 @@ class TokenStore:
 
     async def connect(self) -> None:
         if self._redis_url and redis is not None:
-            kwargs = {"decode_responses": True}
+            # Blocking pool: past max_connections a burst queues for a free connection instead of
+            # failing with "Too many connections".
+            kwargs = {
+                "decode_responses": True,
+                "max_connections": REDIS_MAX_CONNECTIONS,
+                "timeout": REDIS_POOL_TIMEOUT,
+                "socket_keepalive": True,
+                # PING a connection idle this long before reuse, so a dropped socket is replaced up front.
+                "health_check_interval": 30,
+            }
             if self._redis_url.startswith("rediss://"):
                 kwargs["ssl_cert_reqs"] = "none"
             try:
-                self._redis = redis.from_url(self._redis_url, **kwargs)
+                self._pool = redis.BlockingConnectionPool.from_url(self._redis_url, **kwargs)
             except TypeError:
                 # Older redis clients may not support ssl_cert_reqs
                 kwargs.pop("ssl_cert_reqs", None)
-                self._redis = redis.from_url(self._redis_url, **kwargs)
+                self._pool = redis.BlockingConnectionPool.from_url(self._redis_url, **kwargs)
+            self._redis = redis.Redis(connection_pool=self._pool)
+            # Concurrent PINGs each check out their own connection, so the first burst of requests
+            # after boot finds handshaken sockets in the pool; also fails fast on a bad REDIS_URL.
+            await asyncio.gather(*(self._redis.ping() for _ in range(REDIS_WARM_CONNECTIONS)))
 
     async def close(self) -> None:
         if self._redis is not None:
             await self._redis.close()
+        if self._pool is not None:
+            await self._pool.disconnect()
 
     async def set(self, token: str, ref: FileRef, ttl_seconds: int) -> None:
         if self._redis is not None:
-            payload = json.dumps(asdict(ref))
+            payload = _ref_dumps(ref)
+            pipe = self._redis.pipeline(transaction=False)
             if ttl_seconds and ttl_seconds > 0:
-                await self._redis.setex(token, ttl_seconds, payload)
+                pipe.setex(token, ttl_seconds, payload)
             else:
-                await self._redis.set(token, payload)
-            await self._redis.lpush(self._history_key, token)
-            await self._redis.ltrim(self._history_key, 0, self._history_limit - 1)
+                pipe.set(token, payload)
+            pipe.lpush(self._history_key, token)
+            pipe.ltrim(self._history_key, 0, self._history_limit - 1)
             if ref.section_id:
                 section_key = f"section:{ref.section_id}"
-                await self._redis.lpush(section_key, token)
-                await self._redis.ltrim(section_key, 0, self._history_limit - 1)
+                pipe.lpush(section_key, token)
+                pipe.ltrim(section_key, 0, self._history_limit - 1)
+            await pipe.execute()
             return
+        self._sweep_expired()
         self._memory[token] = ref
-        self._history.insert(0, token)
-        if len(self._history) > self._history_limit:
-            self._history = self._history[: self._history_limit]
+        if ttl_seconds and ttl_seconds > 0:
+            expires_at = float(ref.created_at) + ttl_seconds
+            self._memory_expires[token] = expires_at
+            heapq.heappush(self._expiry_heap, (expires_at, token))
+        else:
+            self._memory_expires.pop(token, None)
+        self._history.appendleft(token)
         if ref.section_id:
-            items = self._sections.setdefault(ref.section_id, [])
-            items.insert(0, token)
-            if len(items) > self._history_limit:
-                self._sections[ref.section_id] = items[: self._history_limit]
+            items = self._sections.get(ref.section_id)
+            if items is None:
+                items = self._sections[ref.section_id] = deque(maxlen=self._history_limit)
+            items.appendleft(token)
+
+    async def set_many(self, items: list[tuple[str, FileRef, int]]) -> None:
+        """Store several token refs in one pipelined round trip."""
+        if not items:
+            return
+        if self._redis is not None:
+            pipe = self._redis.pipeline(transaction=False)
+            for token, ref, ttl_seconds in items:
+                payload = _ref_dumps(ref)
+                if ttl_seconds and ttl_seconds > 0:
+                    pipe.setex(token, ttl_seconds, payload)
+                else:
+                    pipe.set(token, payload)
+                pipe.lpush(self._history_key, token)
+                if ref.section_id:
+                    section_key = f"section:{ref.section_id}"
+                    pipe.lpush(section_key, token)
+                    pipe.ltrim(section_key, 0, self._history_limit - 1)
+            pipe.ltrim(self._history_key, 0, self._history_limit - 1)
+            await pipe.execute()
+            return
+        for token, ref, ttl_seconds in items:
+            await self.set(token, ref, ttl_seconds)
 
-    async def get(self, token: str, ttl_seconds: int) -> Optional[FileRef]:
+    async def get(self, token: str) -> Optional[FileRef]:
+        # Redis expires keys itself (SETEX); the memory store is swept against its expiry heap.
         if self._redis is not None:
             raw = await self._redis.get(token)
             if not raw:
                 return None
-            data = json.loads(raw)
-            if "file_id" not in data:
-                data["file_id"] = ""
-            if "access" not in data:
-                data["access"] = "normal"
-            if "section_id" not in data:
-                data["section_id"] = None
-            if "section_name" not in data:
-                data["section_name"] = None
-            return FileRef(**data)
-        ref = self._memory.get(token)
-        if not ref:
-            return None
-        if ttl_seconds > 0 and time.time() - ref.created_at > ttl_seconds:
-            self._memory.pop(token, None)
-            return None
-        return ref
+            return _ref_from_json(raw)
+        self._sweep_expired()
+        return self._memory.get(token)
 
-    async def get_many(self, tokens: list[str], ttl_seconds: int) -> dict[str, FileRef]:
+    async def get_many(self, tokens: list[str]) -> dict[str, FileRef]:
         ordered = [str(token) for token in tokens if token]
         if not ordered:
             return {}
         if self._redis is not None:
-            pipe = self._redis.pipeline()
-            for token in ordered:
-                pipe.get(token)
-            raw_values = await pipe.execute()
+            raw_values = await self._redis.mget(ordered)
             results: dict[str, FileRef] = {}
             for token, raw in zip(ordered, raw_values):
                 if not raw:
                     continue
-                data = json.loads(raw)
-                if "file_id" not in data:
-                    data["file_id"] = ""
-                if "access" not in data:
-                    data["access"] = "normal"
-                if "section_id" not in data:
-                    data["section_id"] = None
-                if "section_name" not in data:
-                    data["section_name"] = None
-                results[token] = FileRef(**data)
+                try:
+                    results[token] = _ref_from_json(raw)
+                except (TypeError, ValueError):
+                    # A corrupt payload is skipped rather than failing the whole listing.
+                    continue
             return results
 
-        results: dict[str, FileRef] = {}
-        for token in ordered:
-            ref = await self.get(token, ttl_seconds)
-            if ref is not None:
-                results[token] = ref
-        return results
+        self._sweep_expired()
+        return {token: self._memory[token] for token in ordered if token in self._memory}
 
 
+    async def update_fields(self, token: str, **fields) -> bool:
+        """Patch stored FileRef fields in place, keeping the token's remaining TTL."""
+        if self._redis is not None:
+            # WATCH/MULTI: if the token is rewritten or expires between the read and the write,
+            # EXEC aborts and the patch is re-applied to the fresh value (or dropped if it is gone).
+            for _ in range(8):
+                pipe = self._redis.pipeline()
+                try:
+                    await pipe.watch(token)
+                    raw = await pipe.get(token)
+                    if not raw:
+                        return False
+                    ref = replace(_ref_from_json(raw), **fields)
+                    pipe.multi()
+                    pipe.set(token, _ref_dumps(ref), keepttl=True)
+                    await pipe.execute()
+                    return True
+                except WatchError:
+                    continue
+                finally:
+                    try:
+                        await pipe.reset()
+                    except Exception:
+                        pass
+            return False
+        ref = self._memory.get(token)
+        if not ref:
+            return False
+        self._memory[token] = replace(ref, **fields)
+        return True
+
     async def list_recent(self, limit: int) -> list[str]:
         limit = max(int(limit), 1)
         if self._redis is not None:
             tokens = await self._redis.lrange(self._history_key, 0, limit - 1)
             return [t for t in tokens if t]
-        return self._history[:limit]
+        return list(islice(self._history, limit))
+
+    async def list_recent_refs(self, limit: int, scan: Optional[int] = None) -> list[tuple[str, FileRef]]:
+        """Return up to ``limit`` live (token, ref) pairs from the newest ``scan`` history entries."""
+        limit = max(int(limit), 1)
+        scan = max(int(scan or limit), limit)
+        # LRANGE then one MGET: every key a command touches is named in it, so this stays valid
+        # on Cluster and key-scoped ACLs, unlike a script that GETs keys it was not handed.
+        tokens = await self.list_recent(scan)
+        refs = await self.get_many(tokens)
+        return [(token, refs[token]) for token in tokens if token in refs][:limit]
 
     async def increment_view(self, token: str, viewer_id: Optional[str], ttl_seconds: int) -> tuple[int, int]:
         if self._redis is not None:
             count_key = f"views:count:{token}"
             unique_key = f"views:unique:{token}"
-            total = await self._redis.incr(count_key)
-            if ttl_seconds and ttl_seconds > 0:
-                await self._redis.expire(count_key, ttl_seconds)
-            unique = 0
+            expires = bool(ttl_seconds and ttl_seconds > 0)
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.incr(count_key)
+            if expires:
+                pipe.expire(count_key, ttl_seconds)
             if viewer_id:
-                await self._redis.sadd(unique_key, viewer_id)
-                if ttl_seconds and ttl_seconds > 0:
-                    await self._redis.expire(unique_key, ttl_seconds)
-                unique = await self._redis.scard(unique_key)
-            return int(total), int(unique)
+                pipe.sadd(unique_key, viewer_id)
+                if expires:
+                    pipe.expire(unique_key, ttl_seconds)
+                pipe.scard(unique_key)
+            values = await pipe.execute()
+            return int(values[0]), int(values[-1]) if viewer_id else 0
 
         total = self._view_counts.get(token, 0) + 1
         self._view_counts[token] = total
@@ -252,12 +419,11 @@ class TokenStore:
 
     async def get_views(self, token: str) -> tuple[int, int]:
         if self._redis is not None:
-            count_key = f"views:count:{token}"
-            unique_key = f"views:unique:{token}"
-            total_raw = await self._redis.get(count_key)
-            total = int(total_raw or 0)
-            unique = await self._redis.scard(unique_key)
-            return total, int(unique)
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.get(f"views:count:{token}")
+            pipe.scard(f"views:unique:{token}")
+            total_raw, unique = await pipe.execute()
+            return int(total_raw or 0), int(unique)
 
         total = self._view_counts.get(token, 0)
         unique = len(self._unique_viewers.get(token, set()))
@@ -318,12 +484,13 @@ class TokenStore:
         if self._redis is not None:
             count_key = f"section:views:count:{section_id}"
             unique_key = f"section:views:unique:{section_id}"
-            total = await self._redis.incr(count_key)
-            unique = 0
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.incr(count_key)
             if viewer_id:
-                await self._redis.sadd(unique_key, viewer_id)
-                unique = await self._redis.scard(unique_key)
-            return int(total), int(unique)
+                pipe.sadd(unique_key, viewer_id)
+                pipe.scard(unique_key)
+            values = await pipe.execute()
+            return int(values[0]), int(values[-1]) if viewer_id else 0
 
         total = self._section_view_counts.get(section_id, 0) + 1
         self._section_view_counts[section_id] = total
@@ -336,12 +503,11 @@ class TokenStore:
 
     async def get_section_views(self, section_id: str) -> tuple[int, int]:
         if self._redis is not None:
-            count_key = f"section:views:count:{section_id}"
-            unique_key = f"section:views:unique:{section_id}"
-            total_raw = await self._redis.get(count_key)
-            total = int(total_raw or 0)
-            unique = await self._redis.scard(unique_key)
-            return total, int(unique)
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.get(f"section:views:count:{section_id}")
+            pipe.scard(f"section:views:unique:{section_id}")
+            total_raw, unique = await pipe.execute()
+            return int(total_raw or 0), int(unique)
 
         total = self._section_view_counts.get(section_id, 0)
         unique = len(self._section_unique_viewers.get(section_id, set()))
@@ -349,23 +515,26 @@ class TokenStore:
 
     async def set_like(self, token: str, viewer_id: str, liked: bool) -> tuple[int, bool]:
         if self._redis is not None:
-            count_key = f"likes:count:{token}"
-            set_key = f"likes:set:{token}"
-            if liked:
-                added = await self._redis.sadd(set_key, viewer_id)
-                if added:
-                    await self._redis.incr(count_key)
-            else:
-                removed = await self._redis.srem(set_key, viewer_id)
-                if removed:
-                    await self._redis.decr(count_key)
-            total_raw = await self._redis.get(count_key)
-            total = int(total_raw or 0)
-            user_liked = await self._redis.sismember(set_key, viewer_id)
-            if total < 0:
-                total = 0
-                await self._redis.set(count_key, 0)
-            return total, bool(user_liked)
+            # One atomic round trip; the viewer's state afterwards is exactly ``liked``.
+            script = """
+if ARGV[2] == '1' then
+  if redis.call('sadd', KEYS[1], ARGV[1]) == 1 then
+    redis.call('incr', KEYS[2])
+  end
+elseif redis.call('srem', KEYS[1], ARGV[1]) == 1 then
+  redis.call('decr', KEYS[2])
+end
+local total = tonumber(redis.call('get', KEYS[2]) or '0')
+if total < 0 then
+  total = 0
+  redis.call('set', KEYS[2], 0)
+end
+return total
+"""
+            total = await self._redis.eval(
+                script, 2, f"likes:set:{token}", f"likes:count:{token}", viewer_id, "1" if liked else "0"
+            )
+            return int(total), liked
 
         viewers = self._like_viewers.setdefault(token, set())
         if liked:
@@ -378,14 +547,12 @@ class TokenStore:
 
     async def get_likes(self, token: str, viewer_id: Optional[str] = None) -> tuple[int, bool]:
         if self._redis is not None:
-            count_key = f"likes:count:{token}"
-            set_key = f"likes:set:{token}"
-            total_raw = await self._redis.get(count_key)
-            total = int(total_raw or 0)
-            user_liked = False
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.get(f"likes:count:{token}")
             if viewer_id:
-                user_liked = bool(await self._redis.sismember(set_key, viewer_id))
-            return total, user_liked
+                pipe.sismember(f"likes:set:{token}", viewer_id)
+            values = await pipe.execute()
+            return int(values[0] or 0), bool(viewer_id) and bool(values[-1])
 
         total = self._like_counts.get(token, len(self._like_viewers.get(token, set())))
         user_liked = False
@@ -397,15 +564,20 @@ class TokenStore:
         if self._redis is not None:
             like_key = f"react:like:{token}"
             dislike_key = f"react:dislike:{token}"
-            likes = await self._redis.scard(like_key)
-            dislikes = await self._redis.scard(dislike_key)
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.scard(like_key)
+            pipe.scard(dislike_key)
+            if user_id is not None:
+                pipe.sismember(like_key, str(user_id))
+                pipe.sismember(dislike_key, str(user_id))
+            values = await pipe.execute()
             status = 0
             if user_id is not None:
-                if await self._redis.sismember(like_key, str(user_id)):
+                if values[2]:
                     status = 1
-                elif await self._redis.sismember(dislike_key, str(user_id)):
+                elif values[3]:
                     status = -1
-            return int(likes), int(dislikes), status
+            return int(values[0]), int(values[1]), status
 
         likes_set = self._react_likes.get(token, set())
         dislikes_set = self._react_dislikes.get(token, set())
@@ -417,29 +589,54 @@ class TokenStore:
                 status = -1
         return len(likes_set), len(dislikes_set), status
 
+    async def toggle_reaction(self, token: str, user_id: int, reaction: int) -> tuple[int, int, int]:
+        """Set reaction (1 or -1) for the user, or clear it if already set; returns (likes, dislikes, status)."""
+        if self._redis is not None:
+            script = """
+local mine, other = KEYS[1], KEYS[2]
+if ARGV[2] == '-1' then
+  mine, other = KEYS[2], KEYS[1]
+end
+local status = 0
+if redis.call('sismember', mine, ARGV[1]) == 1 then
+  redis.call('srem', mine, ARGV[1])
+else
+  redis.call('sadd', mine, ARGV[1])
+  redis.call('srem', other, ARGV[1])
+  status = tonumber(ARGV[2])
+end
+return {redis.call('scard', KEYS[1]), redis.call('scard', KEYS[2]), status}
+"""
+            likes, dislikes, status = await self._redis.eval(
+                script, 2, f"react:like:{token}", f"react:dislike:{token}", str(user_id), str(int(reaction))
+            )
+            return int(likes), int(dislikes), int(status)
+        _, _, status = await self.get_reactions(token, user_id)
+        return await self.set_reaction(token, user_id, 0 if status == reaction else reaction)
+
     async def set_reaction(self, token: str, user_id: int, reaction: int) -> tuple[int, int, int]:
         # reaction: 1=like, -1=dislike, 0=remove
         if self._redis is not None:
             like_key = f"react:like:{token}"
             dislike_key = f"react:dislike:{token}"
             user = str(user_id)
+            # MULTI/EXEC: the write and the counts read back come from one atomic round trip,
+            # and the user's status afterwards is exactly the reaction just written.
+            pipe = self._redis.pipeline()
             if reaction == 1:
-                await self._redis.sadd(like_key, user)
-                await self._redis.srem(dislike_key, user)
+                pipe.sadd(like_key, user)
+                pipe.srem(dislike_key, user)
             elif reaction == -1:
-                await self._redis.sadd(dislike_key, user)
-                await self._redis.srem(like_key, user)
+                pipe.sadd(dislike_key, user)
+                pipe.srem(like_key, user)
             else:
-                await self._redis.srem(like_key, user)
-                await self._redis.srem(dislike_key, user)
-            likes = await self._redis.scard(like_key)
-            dislikes = await self._redis.scard(dislike_key)
-            status = 0
-            if await self._redis.sismember(like_key, user):
-                status = 1
-            elif await self._redis.sismember(dislike_key, user):
-                status = -1
-            return int(likes), int(dislikes), status
+                pipe.srem(like_key, user)
+                pipe.srem(dislike_key, user)
+            pipe.scard(like_key)
+            pipe.scard(dislike_key)
+            values = await pipe.execute()
+            status = reaction if reaction in (1, -1) else 0
+            return int(values[-2]), int(values[-1]), status
 
         likes_set = self._react_likes.setdefault(token, set())
         dislikes_set = self._react_dislikes.setdefault(token, set())
@@ -900,6 +1097,28 @@ return {1, newval}
         self._pay_requests[item["id"]] = item
         return item
 
+    def _payment_hash_to_dict(self, request_id: str, data: dict) -> dict:
+        return {
+            "id": data.get("id", request_id),
+            "user_id": int(data.get("user_id", "0") or 0),
+            "amount_inr": float(data.get("amount_inr", "0") or 0),
+            "credits": int(data.get("credits", "0") or 0),
+            "plan_type": data.get("plan_type", "credits"),
+            "status": data.get("status", "pending"),
+            "gateway": data.get("gateway", "manual"),
+            "created_at": int(data.get("created_at", "0") or 0),
+            "updated_at": int(data.get("updated_at", "0") or 0),
+            "expires_at": int(data.get("expires_at", "0") or 0),
+            "note": data.get("note", ""),
+            "admin_id": int(data.get("admin_id", "0") or 0),
+            "qr_code_id": data.get("qr_code_id", ""),
+            "payment_link": data.get("payment_link", ""),
+            "txn_id": data.get("txn_id", ""),
+            "approved_by": data.get("approved_by", ""),
+            "grant_type": data.get("grant_type", ""),
+            "screenshot_file_id": data.get("screenshot_file_id", ""),
+        }
+
     async def get_payment_request(self, request_id: str) -> Optional[dict]:
         request_id = str(request_id).strip()
         if not request_id:
@@ -908,26 +1127,7 @@ return {1, newval}
             data = await self._redis.hgetall(f"{self._pay_req_prefix}{request_id}")
             if not data:
                 return None
-            return {
-                "id": data.get("id", request_id),
-                "user_id": int(data.get("user_id", "0") or 0),
-                "amount_inr": float(data.get("amount_inr", "0") or 0),
-                "credits": int(data.get("credits", "0") or 0),
-                "plan_type": data.get("plan_type", "credits"),
-                "status": data.get("status", "pending"),
-                "gateway": data.get("gateway", "manual"),
-                "created_at": int(data.get("created_at", "0") or 0),
-                "updated_at": int(data.get("updated_at", "0") or 0),
-                "expires_at": int(data.get("expires_at", "0") or 0),
-                "note": data.get("note", ""),
-                "admin_id": int(data.get("admin_id", "0") or 0),
-                "qr_code_id": data.get("qr_code_id", ""),
-                "payment_link": data.get("payment_link", ""),
-                "txn_id": data.get("txn_id", ""),
-                "approved_by": data.get("approved_by", ""),
-                "grant_type": data.get("grant_type", ""),
-                "screenshot_file_id": data.get("screenshot_file_id", ""),
-            }
+            return self._payment_hash_to_dict(request_id, data)
         req = self._pay_requests.get(request_id)
         if req is not None and "plan_type" not in req:
             req["plan_type"] = "credits"
@@ -1001,6 +1201,72 @@ return {1, newval}
         self._pay_requests[req["id"]] = req
         return req
 
+    async def finalize_payment(
+        self,
+        request_id: str,
+        user_id: int,
+        credits: int,
+        status: str,
+        note: str = "",
+        admin_id: int = 0,
+        append_balance: bool = False,
+        clear_utr: bool = True,
+    ) -> int:
+        """
+        Credit the user and stamp the request status in one step; returns the balance afterwards.
+        ``append_balance`` appends that balance to ``note``; ``clear_utr`` also drops the pending UTR.
+        """
+        user_id = int(user_id)
+        credits = int(credits)
+        status = str(status).strip().lower()
+        note = str(note or "").strip()
+        if append_balance:
+            note = f"{note} "
+        admin_id = int(admin_id or 0)
+        if self._redis is not None:
+            script = """
+local credits = tonumber(ARGV[1])
+local balance
+if credits ~= 0 then
+  balance = redis.call('incrby', KEYS[1], credits)
+else
+  balance = tonumber(redis.call('get', KEYS[1]) or '0')
+end
+if redis.call('exists', KEYS[2]) == 1 then
+  local note = ARGV[3]
+  if ARGV[6] == '1' then
+    note = note .. string.format('%d', balance)
+  end
+  redis.call('hset', KEYS[2], 'status', ARGV[2], 'note', note, 'admin_id', ARGV[4], 'updated_at', ARGV[5])
+end
+if ARGV[7] == '1' then
+  redis.call('del', KEYS[3])
+end
+return balance
+"""
+            balance = await self._redis.eval(
+                script,
+                3,
+                f"credits:{user_id}",
+                f"{self._pay_req_prefix}{str(request_id).strip()}",
+                f"{self._pay_pending_utr_prefix}{user_id}",
+                str(credits),
+                status,
+                note,
+                str(admin_id),
+                str(int(time.time())),
+                "1" if append_balance else "0",
+                "1" if clear_utr else "0",
+            )
+            return int(balance)
+        balance = await self.add_credits(user_id, credits) if credits else await self.get_credits(user_id)
+        if append_balance:
+            note = f"{note}{balance}"
+        await self.set_payment_request_status(request_id, status, note=note, admin_id=admin_id)
+        if clear_utr:
+            await self.clear_pending_utr(user_id)
+        return balance
+
     async def transition_payment_request_status(
         self,
         request_id: str,
@@ -1166,6 +1432,35 @@ return {1, newval}
                 break
         return items
 
+    async def iter_payment_requests(self, status: str = "all", limit: int = 100000, batch_size: int = 500):
+        """Yield payment requests newest first, fetching them in pipelined batches."""
+        status = (status or "all").strip().lower()
+        limit = max(1, int(limit))
+        yielded = 0
+        if self._redis is not None:
+            start = 0
+            while yielded < limit:
+                request_ids = await self._redis.zrevrange(self._pay_req_index, start, start + batch_size - 1)
+                if not request_ids:
+                    return
+                start += len(request_ids)
+                pipe = self._redis.pipeline()
+                for request_id in request_ids:
+                    pipe.hgetall(f"{self._pay_req_prefix}{request_id}")
+                for request_id, data in zip(request_ids, await pipe.execute()):
+                    if not data:
+                        continue
+                    req = self._payment_hash_to_dict(request_id, data)
+                    if status != "all" and req.get("status") != status:
+                        continue
+                    yield req
+                    yielded += 1
+                    if yielded >= limit:
+                        return
+            return
+        for req in await self.list_payment_requests(status=status, limit=limit):
+            yield req
+
     async def get_user_active_payment_request(
         self,
         user_id: int,
@@ -1494,26 +1789,30 @@ return {1, newval}
     async def set_section(self, section_name: Optional[str]) -> Optional[str]:
         if not section_name:
             if self._redis is not None:
-                await self._redis.delete(self._section_key)
-                await self._redis.delete(self._section_name_key)
+                await self._redis.delete(self._section_key, self._section_name_key)
             self._current_section = None
             self._current_section_name = None
             return None
 
         normalized = _normalize_section(section_name)
         section_id = _slugify(section_name)
-        if await self.section_exists(section_name):
-            return None
-        if await self.section_id_exists(section_id):
-            return None
 
         if self._redis is not None:
-            await self._redis.hset(self._section_name_map, normalized, section_id)
-            await self._redis.hset(self._section_id_map, section_id, section_name)
-            await self._redis.set(self._section_key, section_id)
-            await self._redis.set(self._section_name_key, section_name)
+            # Both existence probes in one round trip, then the writes in another.
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.hexists(self._section_name_map, normalized)
+            pipe.hexists(self._section_id_map, section_id)
+            if any(await pipe.execute()):
+                return None
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.hset(self._section_name_map, normalized, section_id)
+            pipe.hset(self._section_id_map, section_id, section_name)
+            pipe.mset({self._section_key: section_id, self._section_name_key: section_name})
+            await pipe.execute()
             return section_id
 
+        if normalized in self._section_registry or section_id in self._section_registry_id:
+            return None
         self._section_registry[normalized] = section_id
         self._section_registry_id[section_id] = section_name
         self._current_section = section_id
@@ -1522,23 +1821,20 @@ return {1, newval}
 
     async def get_section(self) -> tuple[Optional[str], Optional[str]]:
         if self._redis is not None:
-            section_id = await self._redis.get(self._section_key)
-            section_name = await self._redis.get(self._section_name_key)
+            section_id, section_name = await self._redis.mget(self._section_key, self._section_name_key)
             return (section_id or None, section_name or None)
         return (self._current_section, self._current_section_name)
 
     async def set_home_section(self, section_id: Optional[str], section_name: Optional[str] = None) -> None:
         if not section_id:
             if self._redis is not None:
-                await self._redis.delete(self._home_section_key)
-                await self._redis.delete(self._home_section_name_key)
+                await self._redis.delete(self._home_section_key, self._home_section_name_key)
             self._home_section = None
             self._home_section_name = None
             return
 
         if self._redis is not None:
-            await self._redis.set(self._home_section_key, section_id)
-            await self._redis.set(self._home_section_name_key, section_name or section_id)
+            await self._redis.mset({self._home_section_key: section_id, self._home_section_name_key: section_name or section_id})
             return
 
         self._home_section = section_id
@@ -1546,22 +1842,19 @@ return {1, newval}
 
     async def get_home_section(self) -> tuple[Optional[str], Optional[str]]:
         if self._redis is not None:
-            section_id = await self._redis.get(self._home_section_key)
-            section_name = await self._redis.get(self._home_section_name_key)
+            section_id, section_name = await self._redis.mget(self._home_section_key, self._home_section_name_key)
             return (section_id or None, section_name or None)
         return (self._home_section, self._home_section_name)
 
     async def section_exists(self, section_name: str) -> bool:
         normalized = _normalize_section(section_name)
         if self._redis is not None:
-            val = await self._redis.hget(self._section_name_map, normalized)
-            return val is not None
+            return bool(await self._redis.hexists(self._section_name_map, normalized))
         return normalized in self._section_registry
 
     async def section_id_exists(self, section_id: str) -> bool:
         if self._redis is not None:
-            val = await self._redis.hget(self._section_id_map, section_id)
-            return val is not None
+            return bool(await self._redis.hexists(self._section_id_map, section_id))
         return section_id in self._section_registry_id
 
     async def list_sections(self) -> list[tuple[str, str]]:
@@ -1685,20 +1978,20 @@ return {1, newval}
             section_id = await self._redis.hget(self._section_name_map, normalized)
             if not section_id:
                 return False
-            await self._redis.hdel(self._section_name_map, normalized)
-            await self._redis.hdel(self._section_id_map, section_id)
-            await self._redis.hdel(self._public_section_map, section_id)
-            await self._redis.delete(f"section:{section_id}")
-            await self._redis.delete(f"section:views:count:{section_id}")
-            await self._redis.delete(f"section:views:unique:{section_id}")
-            current = await self._redis.get(self._section_key)
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.hdel(self._section_name_map, normalized)
+            pipe.hdel(self._section_id_map, section_id)
+            pipe.hdel(self._public_section_map, section_id)
+            pipe.delete(f"section:{section_id}", f"section:views:count:{section_id}", f"section:views:unique:{section_id}")
+            pipe.mget(self._section_key, self._home_section_key)
+            *_, (current, home) = await pipe.execute()
+            stale = []
             if current and current == section_id:
-                await self._redis.delete(self._section_key)
-                await self._redis.delete(self._section_name_key)
-            home = await self._redis.get(self._home_section_key)
+                stale += [self._section_key, self._section_name_key]
             if home and home == section_id:
-                await self._redis.delete(self._home_section_key)
-                await self._redis.delete(self._home_section_name_key)
+                stale += [self._home_section_key, self._home_section_name_key]
+            if stale:
+                await self._redis.delete(*stale)
             return True
 
         section_id = self._section_registry.get(normalized)
@@ -1724,7 +2017,22 @@ return {1, newval}
         if self._redis is not None:
             tokens = await self._redis.lrange(f"section:{section_id}", 0, limit - 1)
             return [t for t in tokens if t]
-        return self._sections.get(section_id, [])[:limit]
+        return list(islice(self._sections.get(section_id, ()), limit))
+
+    async def list_section_refs(
+        self, section_id: str, limit: int, access: Optional[str] = None
+    ) -> list[tuple[str, FileRef]]:
+        """Return live (token, ref) pairs for a section, optionally only those with the given access."""
+        limit = max(int(limit), 1)
+        access = (access or "").strip().lower()
+        # LRANGE then one MGET, filtered here; see list_recent_refs.
+        tokens = await self.list_section(section_id, limit)
+        refs = await self.get_many(tokens)
+        return [
+            (token, refs[token])
+            for token in tokens
+            if token in refs and (not access or (refs[token].access or "normal").strip().lower() == access)
+        ]
 
     async def create_poll(self, poll_id: str, media_type: str, file_id: Optional[str], caption: Optional[str], text: Optional[str], options: list[str]) -> None:
         if self._redis is not None: